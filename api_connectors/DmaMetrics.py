@@ -0,0 +1,173 @@
+import cProfile
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from prometheus_client import CollectorRegistry, Counter, Gauge, write_to_textfile
+
+STAGE_LABELS = ['data_directory', 'stage']
+STAGE_GAUGES = {
+    'wall_seconds': 'Wall clock time of the last run of the stage',
+    'cpu_seconds': 'CPU time of the thread running the stage',
+    'peak_memory_bytes': 'Growth of the resident set size while the stage ran',
+    'rows_read': 'Rows of the frames the stage was given and read from storage',
+    'rows_written': 'Rows the stage wrote to storage',
+    'bytes_read': 'Size of the files the stage read',
+    'bytes_written': 'Size of the files the stage wrote',
+}
+# only one profiler can be active per process on newer pythons
+profiling = threading.Lock()
+
+
+def resident_memory():
+    """ Resident set size of this process in bytes
+
+        Where /proc is not available (macOS) this is the peak resident set size
+        so far from getrusage, so a stage's growth only shows once it goes past
+        the earlier peak. resource is imported there, it is Unix only and
+        ProcessDMA imports this module also where metrics are not recorded.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PeakMemorySampler(threading.Thread):
+    """ Samples the resident set size in the background to find its peak while a stage runs
+
+        Unlike tracemalloc this does not slow down the code being measured. The
+        resident set size is per process, so stages running at the same time
+        are charged for each other's memory.
+    """
+
+    def __init__(self, interval=0.01):
+        super(PeakMemorySampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.start_rss = resident_memory()
+        self.peak_rss = self.start_rss
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, resident_memory())
+
+    def stop(self):
+        """ Stop sampling, returns the peak growth in bytes """
+        self.stopped.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, resident_memory())
+        return self.peak_rss - self.start_rss
+
+
+class StageMetrics(object):
+    """ Records wall time, CPU time, peak memory, rows and bytes of each ProcessDMA stage
+
+        The last run of every stage is exposed as prometheus gauges on registry
+        (a private one by default) and kept in records. Batch jobs can write the
+        registry to a push-file with write_textfile, for the node exporter's
+        textfile collector or a pushgateway. With a profile_dir every stage also
+        runs under cProfile and its stats are dumped to <profile_dir>/<stage>.prof.
+    """
+
+    def __init__(self, registry=None, profile_dir=None):
+        self.registry = registry if registry is not None else CollectorRegistry()
+        self.profile_dir = profile_dir
+        self.records = []
+        self.gauges = {name: Gauge(f'dma_stage_{name}', description, STAGE_LABELS, registry=self.registry)
+                       for name, description in STAGE_GAUGES.items()}
+        self.runs = Counter('dma_stage_runs_total', 'Runs of the stage by outcome', STAGE_LABELS + ['status'],
+                            registry=self.registry)
+        self.last_success = Gauge('dma_stage_last_success_unixtime', 'End time of the last successful run',
+                                  STAGE_LABELS, registry=self.registry)
+        self.lock = threading.Lock()
+        # the stage being run by each thread, storage reads and writes are charged to it
+        self.current = threading.local()
+
+    def record_io(self, direction, rows, size):
+        """ Count a read or write of rows and size bytes against the stage running in this thread """
+        record = getattr(self.current, 'record', None)
+        if record is not None:
+            record[f'rows_{direction}'] += rows
+            record[f'bytes_{direction}'] += size
+
+    @contextmanager
+    def stage(self, name, data_directory='', inputs=()):
+        """ Measure the code run inside the block as stage name, inputs are the frames it was given """
+        record = {'data_directory': data_directory, 'stage': name, 'status': 'ok', 'profile': None,
+                  'rows_read': sum(len(df) for df in inputs if isinstance(df, pd.DataFrame)),
+                  'rows_written': 0, 'bytes_read': 0, 'bytes_written': 0}
+        self.current.record = record
+        profiler = None
+        if self.profile_dir:
+            if profiling.acquire(blocking=False):
+                profiler = cProfile.Profile()
+            else:
+                logging.info(f"stage {name} is not profiled, another stage is being profiled")
+        sampler = PeakMemorySampler()
+        sampler.start()
+        ts = time.perf_counter()
+        cpu_ts = time.thread_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        except Exception:
+            record['status'] = 'failed'
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+                profiling.release()
+            record['wall_seconds'] = time.perf_counter() - ts
+            record['cpu_seconds'] = time.thread_time() - cpu_ts
+            record['peak_memory_bytes'] = sampler.stop()
+            self.current.record = None
+            if profiler:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record['profile'] = os.path.join(self.profile_dir, f'{name}.prof')
+                profiler.dump_stats(record['profile'])
+            self._publish(record)
+
+    def _publish(self, record):
+        labels = (record['data_directory'], record['stage'])
+        with self.lock:
+            self.records.append(record)
+            for name, gauge in self.gauges.items():
+                if record[name] is not None:
+                    gauge.labels(*labels).set(record[name])
+            self.runs.labels(*labels, record['status']).inc()
+            if record['status'] == 'ok':
+                self.last_success.labels(*labels).set_to_current_time()
+        logging.info(f"stage {record['stage']} {record['status']} in {record['wall_seconds']:.2f}s, "
+                     f"cpu {record['cpu_seconds']:.2f}s, rows read {record['rows_read']} "
+                     f"written {record['rows_written']}")
+
+    def to_frame(self):
+        """ One row per stage run """
+        with self.lock:
+            return pd.DataFrame(self.records)
+
+    def write_textfile(self, path):
+        """ Write the metrics in the prometheus text format, atomically """
+        write_to_textfile(path, self.registry)
+
+
+def instrumented_stage(func):
+    """ Record a ProcessDMA stage on the instance's metrics, when it has them """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.metrics is None:
+            return func(self, *args, **kwargs)
+        with self.metrics.stage(func.__name__, self.data_directory, inputs=args):
+            return func(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,272 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+from api_connectors.DmaMetrics import StageMetrics
+from api_connectors.ProcessDMA import ProcessDMA, ArrowStorage
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    """ Content hash of a file """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def frame_digest(df):
+    """ Content hash of a DataFrame, including its column names """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([str(col) for col in df.columns]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+class Stage(object):
+    """ One step of the pipeline with the files it reads and writes
+
+        inputs and outputs are file paths, a stage runs after the stages that
+        produce its inputs. args are passed to func and are fingerprinted by
+        content, so in-memory frames count as inputs too.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), args=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.args = tuple(args)
+
+    def code_version(self):
+        # the whole module, so changes to the helpers a stage uses count too
+        return file_digest(inspect.getsourcefile(inspect.unwrap(self.func)))
+
+
+class PipelineRunner(object):
+    """ Runs stages in dependency order, concurrently where they are independent
+
+        A stage is skipped when the fingerprint of its code, input files and
+        arguments matches the one recorded after its last successful run and
+        all of its outputs still exist.
+    """
+
+    def __init__(self, stages, cache_path, max_workers=2):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_path = cache_path
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.cache = {'stages': {}, 'files': {}}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.cache = json.load(f)
+
+        producers = {path: stage.name for stage in stages for path in stage.outputs}
+        self.dependencies = {stage.name: {producers[path] for path in stage.inputs if path in producers}
+                             for stage in stages}
+
+    def _input_digest(self, path):
+        # reuse the recorded digest while the file's size and mtime are unchanged
+        stat = os.stat(path)
+        with self.lock:
+            known = self.cache['files'].get(path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+            return known['digest']
+        digest = file_digest(path)
+        with self.lock:
+            self.cache['files'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': digest}
+        return digest
+
+    def fingerprint(self, stage):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(stage.code_version().encode('utf-8'))
+        for path in stage.inputs:
+            digest.update(path.encode('utf-8'))
+            digest.update(self._input_digest(path).encode('utf-8'))
+        for arg in stage.args:
+            arg_digest = frame_digest(arg) if isinstance(arg, pd.DataFrame) else repr(arg)
+            digest.update(arg_digest.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _save_cache(self):
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.cache, f, indent=1)
+        os.replace(tmp_path, self.cache_path)
+
+    def _run_stage(self, stage, force):
+        # fingerprint before running, stages may modify their arguments
+        fingerprint = self.fingerprint(stage)
+        with self.lock:
+            cached = self.cache['stages'].get(stage.name)
+        if not force and cached == fingerprint and all(os.path.exists(path) for path in stage.outputs):
+            logging.info(f"stage {stage.name} is up to date, skipping")
+            return 'cached'
+
+        logging.info(f"running stage {stage.name}")
+        stage.func(*stage.args)
+        with self.lock:
+            self.cache['stages'][stage.name] = fingerprint
+            self._save_cache()
+        return 'ran'
+
+    def run(self, force=False):
+        """ Run every stage that is out of date, returns {stage name: 'ran' | 'cached'} """
+        results = {}
+        errors = {}
+        pending = dict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    dependencies = [results.get(dependency) for dependency in self.dependencies[name]]
+                    if 'failed' in dependencies:
+                        results[name] = 'failed'
+                        errors[name] = 'upstream stage failed'
+                        del pending[name]
+                    elif all(result in ('ran', 'cached') for result in dependencies):
+                        running[pool.submit(self._run_stage, pending.pop(name), force)] = name
+
+                if not running:
+                    if pending:
+                        raise Exception(f"stages with circular inputs: {sorted(pending)}")
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logging.info(f"stage {name} failed: {e}")
+                        results[name] = 'failed'
+                        errors[name] = e
+
+        if errors:
+            raise Exception(f"pipeline stages failed: {errors}")
+        return results
+
+
+def process_dma_stages(dma, population=None, ship_zip=None, ship_zip_path=None, aggregate=False, bootstrap=0):
+    """ Stages of a ProcessDMA run, the census and shipping stages only when their frames are given
+
+        A ship_zip_path is streamed through process_ship_zip_dma_chunks instead
+        of reading the whole customer table into memory. With aggregate the
+        prospects and shoppers aggregates are built from cust_dmas instead of
+        being exported into the data directory. bootstrap resamples add
+        confidence intervals to the expected penetration.
+    """
+    def stored(name):
+        return dma.storage.path(name)
+
+    def census(name):
+        return dma.census.path(name)
+
+    def external(name):
+        return os.path.join(dma.data_directory, name + '.csv')
+
+    # in incremental mode the partition list changes whenever any month is rebuilt
+    numerator = stored('numerator2/_partitions') if dma.incremental else stored('numerator2')
+
+    stages = []
+    if population is not None:
+        stages.append(Stage('process_population', dma.process_population, args=[population],
+                            outputs=[census('population'), census('zip_dma'), census('dma_population')]))
+    if ship_zip is not None:
+        stages.append(Stage('process_ship_zip_dma', dma.process_ship_zip_dma, args=[ship_zip],
+                            inputs=[census('zip_dma')], outputs=[stored('cust_dmas')]))
+    elif ship_zip_path is not None:
+        stages.append(Stage('process_ship_zip_dma', dma.process_ship_zip_dma_chunks, args=[ship_zip_path],
+                            inputs=[census('zip_dma'), ship_zip_path], outputs=[stored('cust_dmas')]))
+    if aggregate:
+        stages.append(Stage('aggregate_customers', dma.aggregate_customers, inputs=[stored('cust_dmas')],
+                            outputs=[external('prospects_agg'), external('shoppers_agg')]))
+    stages.append(Stage('numerator2', dma.numerator2,
+                        inputs=[external('prospects_agg'), external('shoppers_agg')],
+                        outputs=[numerator]))
+    stages.append(Stage('final_denominator', dma.final_denominator, args=[False, bootstrap] if bootstrap else [],
+                        inputs=[census('population'), census('dma_population'), numerator],
+                        outputs=[stored('final_denom2'), stored('penetration_model'),
+                                 stored('penetration_history')]))
+    return stages
+
+
+def run_pipeline(data_directory, population=None, ship_zip=None, storage='csv', incremental=False, max_workers=2,
+                 force=False, metrics=None, aggregate=False, bootstrap=0):
+    """ Run the ProcessDMA stages for a data directory, skipping stages whose inputs have not changed
+
+        Stages that run are recorded on metrics, a StageMetrics, when given.
+    """
+    dma = ProcessDMA(data_directory, storage=storage, incremental=incremental, metrics=metrics)
+    runner = PipelineRunner(process_dma_stages(dma, population, ship_zip, aggregate=aggregate, bootstrap=bootstrap),
+                            cache_path=os.path.join(data_directory, '.pipeline_cache.json'),
+                            max_workers=max_workers)
+    return runner.run(force=force)
+
+
+def _run_tenant(data_directory, census_directory, storage, incremental, metrics, profile, aggregate):
+    """ Pipeline of one data directory against the shared census, run inside a pool worker """
+    ts = time.time()
+    stage_metrics = None
+    if metrics or profile:
+        stage_metrics = StageMetrics(profile_dir=os.path.join(data_directory, 'profiles') if profile else None)
+    row = {'data_directory': data_directory, 'status': 'ok', 'stages': None, 'error': None, 'metrics_error': None}
+    try:
+        # uncompressed census files are memory mapped, so workers share the page cache instead of a copy each
+        dma = ProcessDMA(data_directory, storage=storage, incremental=incremental,
+                         census=ArrowStorage(census_directory, compression=None), metrics=stage_metrics)
+        ship_zip_path = os.path.join(data_directory, 'ship_zip.csv')
+        if not os.path.exists(ship_zip_path):
+            ship_zip_path = None
+        runner = PipelineRunner(process_dma_stages(dma, ship_zip_path=ship_zip_path, aggregate=aggregate),
+                                cache_path=os.path.join(data_directory, '.pipeline_cache.json'))
+        row['stages'] = runner.run()
+    except Exception:
+        row['status'] = 'failed'
+        row['error'] = traceback.format_exc()
+    # failed stages are recorded too
+    if metrics:
+        try:
+            stage_metrics.write_textfile(os.path.join(data_directory, 'dma_metrics.prom'))
+        except Exception:
+            row['metrics_error'] = traceback.format_exc()
+    row['seconds'] = time.time() - ts
+    return row
+
+
+def run_tenants(data_directories, census_directory, population=None, storage='csv', incremental=False,
+                max_workers=4, metrics=False, profile=False, aggregate=False):
+    """ Run the pipelines of several data directories (brands / regions) on a process pool
+
+        The census tables are built once into census_directory (from population
+        when given, otherwise they must already be there) and shared read-only
+        by every worker. Each data directory needs its prospects_agg.csv and
+        shoppers_agg.csv, and a ship_zip.csv to tag customers. A failing tenant
+        does not stop the others; returns one summary row per data directory,
+        with metrics_error set when its metrics could not be written.
+
+        With metrics every worker writes the metrics of the stages it ran to
+        dma_metrics.prom in its data directory, with profile it dumps a cProfile
+        of every stage into a profiles sub directory. With aggregate the
+        prospects and shoppers aggregates are built from the tagged customers.
+    """
+    if population is not None:
+        ProcessDMA(census_directory, storage=ArrowStorage(census_directory, compression=None)).process_population(
+            population)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_run_tenant, data_directory, census_directory, storage, incremental, metrics, profile,
+                               aggregate)
+                   for data_directory in data_directories]
+        summary = pd.DataFrame([future.result() for future in futures])
+
+    for row in summary.itertuples():
+        logging.info(f"{row.data_directory}: {row.status} in {row.seconds:.1f}s")
+    return summary
@@ -3,18 +3,798 @@ import numpy as np
 import os
 import logging
 import datetime
-import statsmodels.api as sm
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from api_connectors.DmaMetrics import instrumented_stage
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+# census / shopper dma names mapped to the canonical dma name
+DMA_ALIASES = {
+    'Albany et al, NY': 'Albany-Schenectady-Troy, NY',
+    'Birmingham et al, AL': 'Birmingham (Anniston and Tuscaloosa), AL',
+    'Bluefield et al, WV': 'Bluefield-Beckley-Oak Hill, WV',
+    'Boston et al, MA-NH': 'Boston, MA (Manchester, NH)',
+    'Burlington et al, VT-NY': 'Burlington, VT-Plattsburgh, NY',
+    'Cedar Rapids et al, IA': 'Cedar Rapids-Waterloo-Iowa City & Dubuque, IA',
+    'Champaign et al, IL': 'Champaign & Springfield-Decatur, IL',
+    'Charleston et al, WV': 'Charleston-Huntington, WV',
+    'Cheyenne et al, WY-NE': 'Cheyenne, WY-Scottsbluff, NE',
+    'Cleveland et al, OH': 'Cleveland-Akron (Canton), OH',
+    'Colorado Sprgs et al, CO': 'Colorado Springs-Pueblo, CO',
+    'Columbia et al, MO': 'Columbia-Jefferson City, MO',
+    'Columbus et al, MS': 'Columbus-Tupelo-West Point, MS',
+    'Davenport et al, IA-IL': 'Davenport, IA-Rock Island-Moline, IL',
+    'Duluth-Superior, MN-WI': 'Duluth, MN-Superior, WI',
+    'El Paso et al, TX-NM': 'El Paso, TX',
+    'Elmira et al, NY': 'Elmira, NY',
+    'Flint-Saginaw et al, MI': 'Flint-Saginaw-Bay City, MI',
+    'Ft. Smith et al, AR': 'Ft. Smith-Fayetteville-Springdale-Rogers, AR',
+    'Grand Junction et al, CO': 'Grand Junction-Montrose, CO',
+    'Grand Rapids et al, MI': 'Grand Rapids-Kalamazoo-Battle Creek, MI',
+    'Greensboro et al, NC': 'Greensboro-High Point-Winston Salem, NC',
+    'Greenville et al, NC': 'Greenville-New Bern-Washington, NC',
+    'Greenville et al, SC-NC': 'Greenville-Spartanburg, SC-Asheville, NC-Anderson, SC',
+    'Harlingen et al, TX': 'Harlingen-Weslaco-Brownsville-McAllen, TX',
+    'Harrisburg et al, PA': 'Harrisburg-Lancaster-Lebanon-York, PA',
+    'Huntsville et al, AL': 'Huntsville-Decatur (Florence), AL',
+    'Idaho Falls et al, ID': 'Idaho Falls-Pocatello, ID',
+    'Joplin-Pittsburg, MO-KS': 'Joplin, MO-Pittsburg, KS',
+    'Kansas City, MO-KS': 'Kansas City, MO',
+    'Lincoln et al, NE': 'Lincoln & Hastings-Kearney, NE',
+    'Little Rock et al, AR': 'Little Rock-Pine Bluff, AR',
+    'Medford et al, OR': 'Medford-Klamath Falls, OR',
+    'Miami-Ft. Lauderdale, FL': 'Miami-Fort Lauderdale, FL',
+    'Minot et al, ND': 'Minot-Bismarck-Dickinson(Williston), ND',
+    'Mobile et al, AL-FL': 'Mobile, AL-Pensacola (Ft. Walton Beach), FL',
+    'Monroe-El Dorado, LA-AR': 'Monroe, LA-El Dorado, AR',
+    'Myrtle Beach et al, SC': 'Myrtle Beach-Florence, SC',
+    'Norfolk et al, VA': 'Norfolk-Portsmouth-Newport News, VA',
+    'Orlando et al, FL': 'Orlando-Daytona Beach-Melbourne, FL',
+    'Ottumwa et al, IA-MO': 'Ottumwa, IA-Kirksville, MO',
+    'Paducah et al, KY-MO-IL': 'Paducah, KY-Cape Girardeau, MO-Harrisburg, IL',
+    'Phoenix et al, AZ': 'Phoenix, AZ',
+    'Providence et al, RI-MA': 'Providence, RI-New Bedford, MA',
+    'Quincy et al, IL-MO-IA': 'Quincy, IL-Hannibal, MO-Keokuk, IA',
+    'Raleigh et al, NC': 'Raleigh-Durham (Fayetteville), NC',
+    'Rochester et al, MN-IA': 'Rochester, MN-Mason City, IA-Austin, MN',
+    'Sacramento et al, CA': 'Sacramento-Stockton-Modesto, CA',
+    'San Francisco et al, CA': 'San Francisco-Oakland-San Jose, CA',
+    'Santa Barbara et al, CA': 'Santa Barbara-Santa Maria-San Luis Obispo, CA',
+    'Sherman-Ada, TX-OK': 'Sherman, TX-Ada, OK',
+    'Sioux Falls et al, SD': 'Sioux Falls (Mitchell), SD',
+    'Tallahassee et al, FL-GA': 'Tallahassee, FL-Thomasville, GA',
+    'Tampa et al, FL': 'Tampa-St. Petersburg (Sarasota), FL',
+    'Traverse City et al, MI': 'Traverse City-Cadillac, MI',
+    'Tucson(Sierra Vista), AZ': 'Tucson (Sierra Vista), AZ',
+    'Tyler-Longview et al, TX': 'Tyler-Longview(Lufkin & Nacogdoches), TX',
+    'W. Palm Beach et al, FL': 'West Palm Beach-Ft. Pierce, FL',
+    'Washington et al, DC-MD': 'Washington, DC (Hagerstown, MD)',
+    'Wheeling et al, WV-OH': 'Wheeling, WV-Steubenville, OH',
+    'Wichita Fls et al, TX-OK': 'Wichita Falls, TX-Lawton, OK',
+    'Wichita et al, KS': 'Wichita-Hutchinson, KS Plus',
+    'Wilkes Barre et al, PA': 'Wilkes Barre-Scranton, PA',
+    'Yakima et al, WA': 'Yakima-Pasco-Richland-Kennewick, WA',
+    'Yuma-El Centro, AZ-CA': 'Yuma, AZ-El Centro, CA',
+}
+
+
+def canonicalize_dma(dma, aliases=DMA_ALIASES, missing=None):
+    """ Map every dma name in a series to its canonical name, nulls become `missing`
+
+        Aliases are resolved once per distinct name and gathered back by code,
+        so the cost does not grow with the number of aliases.
+    """
+    codes, uniques = pd.factorize(dma)
+    # the trailing slot is picked up by the -1 code factorize gives to nulls
+    canonical = np.array([aliases.get(name, name) for name in uniques] + [missing], dtype=object)
+    values = canonical[codes]
+    if isinstance(dma.dtype, pd.CategoricalDtype):
+        values = pd.Categorical(values)
+    return pd.Series(values, index=dma.index, name=dma.name)
+
+
+def weighted_averages(df, data_cols, weight_col, by_col):
+    """ Weighted mean of several columns per group, returned as one row per group
+
+        Null values (and null weights) do not count towards a column's weight.
+        All columns are reduced together in a single pass over a sorted matrix
+        and the input frame is not modified.
+    """
+    codes, groups = pd.factorize(df[by_col], sort=True)
+    values = df[data_cols].to_numpy(dtype=np.float64)
+    weights = df[weight_col].to_numpy(dtype=np.float64)
+
+    # rows with a null group are dropped, like groupby does
+    order = np.argsort(codes, kind='mergesort')
+    order = order[codes[order] >= 0]
+    codes, values, weights = codes[order], values[order], weights[order]
+
+    with np.errstate(invalid='ignore'):
+        weighted = values * weights[:, None]
+    weighted[np.isnan(weighted)] = 0
+    weight_where_notnull = np.where(np.isnan(values), 0, weights[:, None])
+    weight_where_notnull[np.isnan(weight_where_notnull)] = 0
+
+    # each group is a contiguous block of the sorted matrix
+    matrix = np.hstack([weighted, weight_where_notnull])
+    if len(codes):
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        sums = np.add.reduceat(matrix, starts, axis=0)
+    else:
+        sums = matrix
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums[:, :len(data_cols)] / sums[:, len(data_cols):]
+
+    result = pd.DataFrame(means, columns=['w_avg_' + col for col in data_cols])
+    result.insert(0, by_col, np.asarray(groups))
+    return result
+
+
+def narrowest_numeric(values):
+    """ Parse a column into the narrowest numeric dtype that holds every value exactly """
+    values = pd.to_numeric(values)
+    if values.dtype.kind == 'f' and values.notnull().all() and (values % 1 == 0).all():
+        values = values.astype(np.int64)
+    if values.dtype.kind in 'iu':
+        values = pd.to_numeric(values, downcast='integer')
+    return values
+
+
+def ingest_frame(df, numeric_cols, categorical_cols=()):
+    """ Convert columns of a raw frame in place and log its memory footprint before and after
+
+        Numeric columns are parsed straight from their raw values, without an
+        intermediate string copy. Returns the (before, after) size in bytes.
+    """
+    before = df.memory_usage(deep=True).sum()
+    for col in dict.fromkeys(numeric_cols):
+        df[col] = narrowest_numeric(df[col])
+    for col in categorical_cols:
+        df[col] = df[col].astype('category')
+    after = df.memory_usage(deep=True).sum()
+    logging.info(f"memory footprint of {len(df)} rows went from {before / 2 ** 20:.1f} MB to {after / 2 ** 20:.1f} MB")
+    return before, after
+
+
+ZIP_DIGIT_WEIGHTS = np.array([10000, 1000, 100, 10, 1], dtype=np.int32)
+
+
+def normalize_zip(zips, pad=False):
+    """ Encode zip codes as integers, -1 where the zip is not valid
+
+        Only the first five characters are used, so zip+4 codes are cut down.
+        With pad=True shorter numeric zips are taken as having lost their
+        leading zeros, otherwise a zip needs all five digits.
+    """
+    zips = np.asarray(zips)
+    if zips.dtype.kind in 'iuf':
+        valid = (zips >= 0) & (zips < ZipDmaIndex.size) & (zips % 1 == 0)
+        return np.where(valid, zips, -1).astype(np.int32)
+
+    # fixed width unicode keeps the first 5 characters, shorter zips are padded with \0
+    chars = zips.astype(object).astype('U5').view(np.uint32).reshape(-1, 5)
+    digits = chars - ord('0')
+    is_digit = digits <= 9
+    if pad:
+        present = chars != 0
+        valid = present[:, 0] & (is_digit | ~present).all(axis=1)
+        # read the digits left aligned, then shift right by the missing length
+        codes = np.where(is_digit, digits, 0).astype(np.int32) @ ZIP_DIGIT_WEIGHTS
+        codes //= 10 ** (5 - present.sum(axis=1))
+    else:
+        valid = is_digit.all(axis=1)
+        codes = digits.astype(np.int32) @ ZIP_DIGIT_WEIGHTS
+    return np.where(valid, codes, -1).astype(np.int32)
+
+
+def format_zip(zip_codes):
+    """ Turn integer zip codes back into 5 character strings """
+    zip_codes = np.asarray(zip_codes)
+    # zfill fails on empty arrays in some numpy versions
+    if not len(zip_codes):
+        return zip_codes.astype(object)
+    return np.char.zfill(zip_codes.astype('U5'), 5).astype(object)
+
+
+class ZipDmaIndex(object):
+    """ Dense zip -> dma lookup with a slot for every possible zip code
+
+        Tagging a batch of zip codes is a single gather from the table.
+    """
+    size = 100000
+
+    def __init__(self, zip_dma):
+        zip_codes = normalize_zip(zip_dma['zip'], pad=True)
+        keep = (zip_codes >= 0) & zip_dma['dma'].notnull().to_numpy()
+        labels = zip_dma.loc[keep, ['dma', 'dma_cd']]
+
+        # one id per distinct (dma, dma_cd)
+        self.dmas = labels.drop_duplicates().reset_index(drop=True)
+        dma_ids = pd.MultiIndex.from_frame(self.dmas).get_indexer(pd.MultiIndex.from_frame(labels))
+
+        # the extra last slot stays -1 so invalid (-1) zip codes gather "not found"
+        self.table = np.full(self.size + 1, -1, dtype=np.int32)
+        self.table[zip_codes[keep]] = dma_ids
+
+    def lookup(self, zip_codes):
+        """ Return the dma id of every zip code, -1 where the zip has no dma """
+        return self.table[zip_codes]
+
+
+# columns of the customer shipping zip frame, created_month (the signup month) may be left out
+SHIP_ZIP_COLUMNS = ['customer_key', 'first_order_month', 'zip', 'lifetime_net_amount', 'total_orders',
+                    'created_month']
+# arrow types of the stored frames that are written in chunks, whose dtypes read_csv infers chunk by chunk
+FRAME_SCHEMAS = {
+    'cust_dmas': [('customer_key', 'string'), ('first_order_month', 'string'), ('zip_clean', 'string'),
+                  ('dma', 'string'), ('dma_cd', 'string'), ('lifetime_net_amount', 'double'),
+                  ('total_orders', 'int64'), ('created_month', 'string')],
+}
+
+
+def tag_ship_zip(ship_zip, zip_index):
+    """ Customers of ship_zip with the dma of their zip, dropping customers with zips not on census data """
+    # zips are cut to 5 digits, 'n/a' and zips with weird characters get no code
+    zip_codes = normalize_zip(ship_zip['zip'])
+
+    dma_ids = zip_index.lookup(zip_codes)
+    found = dma_ids >= 0
+    dmas = zip_index.dmas.take(dma_ids[found])
+    created_month = ship_zip['created_month'].to_numpy()[found] if 'created_month' in ship_zip else None
+
+    return pd.DataFrame({
+        'customer_key': ship_zip['customer_key'].to_numpy()[found],
+        'first_order_month': ship_zip['first_order_month'].to_numpy()[found],
+        'zip_clean': format_zip(zip_codes[found]),
+        'dma': dmas['dma'].to_numpy(),
+        'dma_cd': dmas['dma_cd'].to_numpy(),
+        'lifetime_net_amount': ship_zip['lifetime_net_amount'].to_numpy()[found],
+        'total_orders': ship_zip['total_orders'].to_numpy()[found],
+        'created_month': created_month,
+    })
+
+
+# features of the penetration regression
+PENETRATION_FEATURES = ['w_avg_col_hh_med_income', 'w_avg_col_median_age', 'w_avg_col_hu_med_home_value',
+                        'w_avg_attained_hs_or_less_pct', 'wa_bachelors_and_graduate_pct', 'w_avg_col_white_pct']
+
+
+def penetration_features(df):
+    """ Regression features from the per dma weighted averages """
+    features = df[PENETRATION_FEATURES[:4] + PENETRATION_FEATURES[5:]].copy()
+    features.insert(4, 'wa_bachelors_and_graduate_pct',
+                    df['w_avg_col_attained_bachelors_pct'] + df['w_avg_col_attained_graduate_professional_pct'])
+    return features
+
+
+def fit_by_month(X, y, months):
+    """ Least squares fit of y on X (no intercept) for every month at once
+
+        Months are stacked into one zero padded (months, rows, features) array
+        and solved with a batched pseudo-inverse, which gives the same fit as
+        sm.OLS. Rows with missing values are left out. Returns one row per
+        month with its coefficients, n_obs, rank, ssr, r_squared (uncentered,
+        as there is no intercept) and rmse.
+    """
+    features = list(X.columns)
+    X = X.to_numpy(dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    keep = np.isfinite(X).all(axis=1) & np.isfinite(y)
+    codes, labels = pd.factorize(np.asarray(months)[keep], sort=True)
+    X, y = X[keep], y[keep]
+
+    # position of every row within its month
+    n_obs = np.bincount(codes, minlength=len(labels))
+    order = np.argsort(codes, kind='mergesort')
+    position = np.empty(len(codes), dtype=np.int64)
+    position[order] = np.arange(len(codes)) - np.repeat(np.cumsum(n_obs) - n_obs, n_obs)
+
+    stacked_X = np.zeros((len(labels), n_obs.max() if len(codes) else 0, len(features)))
+    stacked_y = np.zeros(stacked_X.shape[:2])
+    stacked_X[codes, position] = X
+    stacked_y[codes, position] = y
+
+    coefficients = (np.linalg.pinv(stacked_X) @ stacked_y[..., None])[..., 0]
+    residuals = stacked_y - (stacked_X @ coefficients[..., None])[..., 0]
+    ssr = (residuals ** 2).sum(axis=1)
+    rank = np.linalg.matrix_rank(stacked_X) if len(codes) else np.zeros(0, dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_squared = 1 - ssr / (stacked_y ** 2).sum(axis=1)
+        rmse = np.sqrt(ssr / (n_obs - rank))
+
+    model = pd.DataFrame(coefficients, columns=features)
+    model.insert(0, 'month', np.asarray(labels))
+    model['n_obs'] = n_obs
+    model['rank'] = rank
+    model['ssr'] = ssr
+    model['r_squared'] = r_squared
+    model['rmse'] = rmse
+    return model
+
+
+def predict_by_month(model, X):
+    """ Predictions of every row of X under every month's coefficients, shaped (months, rows) """
+    return model[list(X.columns)].to_numpy(dtype=np.float64) @ X.to_numpy(dtype=np.float64).T
+
+
+def bootstrap_predictions(X, y, X_new, resamples, seed):
+    """ Predictions for X_new of the least squares fits of resamples bootstrap draws of the rows of (X, y)
+
+        Every draw is a row of resample counts, so all of them are solved as one
+        batch of weighted normal equations. Returns an array shaped
+        (resamples, rows of X_new).
+    """
+    rng = np.random.default_rng(seed)
+    n = len(X)
+    draws = rng.integers(0, n, (resamples, n))
+    # how often each row was drawn, per resample
+    weights = np.bincount((draws + n * np.arange(resamples)[:, None]).ravel(),
+                          minlength=resamples * n).reshape(resamples, n)
+    weighted_Xt = (weights[:, :, None] * X).transpose(0, 2, 1)
+    coefficients = (np.linalg.pinv(weighted_Xt @ X) @ (weighted_Xt @ y)[..., None])[..., 0]
+    return coefficients @ X_new.T
+
+
+def bootstrap_intervals(X, y, X_new, resamples=2000, confidence=0.95, seed=0, max_workers=1, batch_size=500):
+    """ Pairs bootstrap confidence intervals of the least squares predictions for X_new
+
+        Resamples are drawn in batches of batch_size, each with its own seed
+        from seed, so the intervals do not depend on max_workers. Batches run
+        on a process pool when max_workers is more than one. Rows of (X, y)
+        with missing values are left out. Returns the lower and upper bounds.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    X_new = np.asarray(X_new, dtype=np.float64)
+    keep = np.isfinite(X).all(axis=1) & np.isfinite(y)
+    X, y = X[keep], y[keep]
+    if not len(X):
+        return np.full(len(X_new), np.nan), np.full(len(X_new), np.nan)
+
+    sizes = [min(batch_size, resamples - start) for start in range(0, resamples, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = ([X] * len(sizes), [y] * len(sizes), [X_new] * len(sizes), sizes, seeds)
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            predictions = np.concatenate(list(pool.map(bootstrap_predictions, *args)))
+    else:
+        predictions = np.concatenate(list(map(bootstrap_predictions, *args)))
+
+    tail = (1 - confidence) / 2 * 100
+    lower, upper = np.percentile(predictions, [tail, 100 - tail], axis=0)
+    return lower, upper
+
+
+def build_numerator(prospects_agg, shoppers_agg):
+    """ Numerator rows from (month, dma, count) prospects and shoppers aggregates """
+    prospects_agg = prospects_agg.assign(cust_type='Prospects Only')
+    shoppers_agg = shoppers_agg.assign(cust_type='Shoppers Only')
+
+    numerator = pd.concat([shoppers_agg, prospects_agg])
+
+    numerator = numerator[numerator['count'] > 0]
+
+    numerator_both = numerator.groupby(['month', 'dma'])['count'].sum().reset_index()
+    numerator_both['cust_type'] = 'Shoppers + Prospects'
+
+    numerator2 = pd.concat([numerator, numerator_both])
+
+    numerator2 = numerator2.sort_values(['month', 'dma'])
+
+    # change null dma names to DMA not found and use the canonical dma names
+    numerator2['dma'] = canonicalize_dma(numerator2['dma'], missing="DMA Not Found")
+
+    numerator2['last_update_datetime'] = datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")
+    numerator2['last_update_datetime'] = pd.to_datetime(numerator2['last_update_datetime'],
+                                                        format="%m/%d/%Y %H:%M:%S")
+    return numerator2
+
+
+class MonthDmaCounts(object):
+    """ Prospect and shopper counts per month and dma, built up one chunk of customers at a time
+
+        Customers with orders count as shoppers in the month of their first
+        order, the others as prospects in the month they signed up
+        (created_month), both in the dma of their zip. Months are kept as
+        'YYYY-MM-01' strings whatever type they come in. Each chunk is
+        counted with a single bincount over integer encoded (type, month, dma)
+        keys and folded into a small hash table, so counts of separate chunks,
+        files or runs can be merged in any order.
+    """
+    cust_types = ['prospects', 'shoppers']
+
+    def __init__(self, counts=None):
+        # {(cust_type, month, dma): count}, missing months and dmas are None
+        self.counts = dict(counts or {})
+
+    def update(self, customers):
+        """ Count a frame of customers with first_order_month, created_month, dma and total_orders columns """
+        shoppers = (customers['total_orders'].to_numpy() > 0).astype(np.int64)
+        months = customers['first_order_month'].to_numpy(dtype=object)
+        if 'created_month' in customers:
+            months = np.where(shoppers, months, customers['created_month'].to_numpy(dtype=object))
+        month_codes, months = pd.factorize(months)
+        dma_codes, dmas = pd.factorize(customers['dma'])
+        # missing values (-1) get the extra last slot
+        months = month_starts(months) + [None]
+        dmas = list(dmas) + [None]
+        month_codes[month_codes < 0] = len(months) - 1
+        dma_codes[dma_codes < 0] = len(dmas) - 1
+
+        keys = (shoppers * len(months) + month_codes) * len(dmas) + dma_codes
+        counts = np.bincount(keys, minlength=len(self.cust_types) * len(months) * len(dmas))
+        for key in np.flatnonzero(counts):
+            type_month, dma = divmod(int(key), len(dmas))
+            cust_type, month = divmod(type_month, len(months))
+            key_tuple = (self.cust_types[cust_type], months[month], dmas[dma])
+            self.counts[key_tuple] = self.counts.get(key_tuple, 0) + int(counts[key])
+        return self
+
+    def merge(self, other):
+        """ Add the counts of another MonthDmaCounts """
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        return self
+
+    def to_frame(self):
+        """ One (cust_type, month, dma, count) row per key """
+        rows = [key + (count,) for key, count in self.counts.items()]
+        return pd.DataFrame(rows, columns=['cust_type', 'month', 'dma', 'count'])
+
+    @classmethod
+    def from_frame(cls, df):
+        df = df.astype(object).where(df.notnull(), None)
+        month_codes, months = pd.factorize(df['month'].to_numpy())
+        months = np.array(month_starts(months) + [None], dtype=object)[month_codes]
+        counts = cls()
+        for key, count in zip(zip(df['cust_type'], months, df['dma']), df['count'].astype(int)):
+            counts.counts[key] = counts.counts.get(key, 0) + count
+        return counts
+
+    def aggregates(self):
+        """ The (month, dma, count) prospects_agg and shoppers_agg frames numerator2 reads """
+        counts = self.to_frame()
+        return [counts.loc[counts['cust_type'] == cust_type, ['month', 'dma', 'count']]
+                .sort_values(['month', 'dma']).reset_index(drop=True)
+                for cust_type in self.cust_types]
+
+
+def month_starts(months):
+    """ 'YYYY-MM-01' string of the month of every distinct month or date value """
+    return list(pd.to_datetime(pd.Index(months)).strftime('%Y-%m-01'))
+
+
+# cust_dmas columns the customer counts need, created_month is missing from older files
+COUNT_COLUMNS = ['first_order_month', 'dma', 'total_orders', 'created_month']
+
+
+def count_customers_csv(path, chunksize=100000):
+    """ MonthDmaCounts of a cust_dmas csv, read chunksize rows at a time (runs in pool workers) """
+    counts = MonthDmaCounts()
+    for customers in pd.read_csv(path, sep='|', quotechar='"', chunksize=chunksize,
+                                 usecols=lambda column: column in COUNT_COLUMNS):
+        counts.update(customers)
+    return counts
+
+
+def month_partitions(months):
+    """ 'YYYY-MM' partition key of every row, each distinct month is only parsed once """
+    codes, uniques = pd.factorize(months)
+    keys = np.append(pd.to_datetime(uniques).strftime('%Y-%m').to_numpy(dtype=object), 'unknown')
+    return keys[codes]
+
+
+def numerator_code_digest():
+    """ Hash of the code and dma aliases numerator partitions are built with, a change rebuilds every month """
+    digest = hashlib.blake2b(digest_size=8)
+    with open(os.path.abspath(__file__), 'rb') as f:
+        digest.update(f.read())
+    # the aliases can be changed at run time too
+    digest.update(repr(sorted(DMA_ALIASES.items())).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def rows_digest(df):
+    """ Hash of a frame's rows that does not depend on their order """
+    row_hashes = np.sort(pd.util.hash_pandas_object(df, index=False).to_numpy())
+    return hashlib.blake2b(row_hashes.tobytes(), digest_size=8).hexdigest()
+
+
+class CsvStorage(object):
+    """ Pipe delimited csv files in a directory, the original ProcessDMA format """
+    extension = '.csv'
+    # final outputs are not fully quoted
+    unquoted = ('numerator2', 'final_denom2')
+    # a StageMetrics that counts the rows and bytes of every read and write
+    metrics = None
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name + self.extension)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def remove(self, name):
+        os.remove(self.path(name))
+
+    def _prepare(self, name):
+        # names like numerator2/2019-03 are stored in sub directories
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _record(self, direction, name, rows):
+        if self.metrics is not None:
+            self.metrics.record_io(direction, rows, os.path.getsize(self.path(name)))
+
+    def write(self, df, name):
+        quoting = 0 if name.split('/')[0] in self.unquoted else 1
+        df.to_csv(self._prepare(name), sep='|', index=False, encoding='utf-8', quoting=quoting)
+        self._record('written', name, len(df))
+
+    def write_chunks(self, chunks, name):
+        """ Write an iterable of frames one after the other as the frame name, returns the number of rows """
+        path = self._prepare(name)
+        quoting = 0 if name.split('/')[0] in self.unquoted else 1
+        rows = 0
+        chunk = -1
+        with open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+            for chunk, df in enumerate(chunks):
+                df.to_csv(f, sep='|', index=False, quoting=quoting, header=chunk == 0)
+                rows += len(df)
+        if chunk < 0:
+            os.remove(path + '.tmp')
+            raise ValueError(f"no frames to write to {name}")
+        # readers never see a half written file
+        os.replace(path + '.tmp', path)
+        self._record('written', name, rows)
+        return rows
+
+    def read(self, name, columns=None):
+        df = pd.read_csv(self.path(name), sep='|', quotechar='"', usecols=columns)
+        self._record('read', name, len(df))
+        return df
+
+    def read_chunks(self, name, columns=None, chunksize=100000):
+        """ Read the frame name chunksize rows at a time """
+        rows = 0
+        for df in pd.read_csv(self.path(name), sep='|', quotechar='"', usecols=columns, chunksize=chunksize):
+            rows += len(df)
+            yield df
+        self._record('read', name, rows)
+
+
+class ArrowStorage(CsvStorage):
+    """ Typed, compressed Arrow IPC (feather v2) files
+
+        The schema is stored with the data so dtypes survive the round trip,
+        reads can be limited to a subset of columns and files are memory
+        mapped. Use compression=None for zero copy reads of the mapped file.
+        Frames with a schema in schemas (FRAME_SCHEMAS by default) are cast to
+        it, so every chunk and every run stores the same types; the others keep
+        the types of their first chunk.
+    """
+    extension = '.arrow'
+
+    def __init__(self, directory, compression='zstd', memory_map=True, schemas=None):
+        if pa is None:
+            raise ImportError('pyarrow is required for the arrow storage backend')
+        super(ArrowStorage, self).__init__(directory)
+        self.compression = compression
+        self.memory_map = memory_map
+        self.schemas = {name: pa.schema([(column, pa.type_for_alias(type_name)) for column, type_name in fields])
+                        for name, fields in (FRAME_SCHEMAS if schemas is None else schemas).items()}
+
+    def _table(self, df, name, schema=None):
+        """ df as an arrow table, cast to the schema of the frame name or to schema """
+        schema = self.schemas.get(name.split('/')[0], schema)
+        if schema is None:
+            return pa.Table.from_pandas(df, preserve_index=False)
+        return pa.Table.from_pandas(df[schema.names], preserve_index=False).cast(schema)
+
+    def write(self, df, name):
+        table = self._table(df, name)
+        feather.write_feather(table, self._prepare(name), compression=self.compression or 'uncompressed')
+        self._record('written', name, len(df))
+
+    def _file_writer(self, sink, schema):
+        # compressed streaming writes need a newer pyarrow, older versions write uncompressed
+        if self.compression and hasattr(pa.ipc, 'IpcWriteOptions'):
+            return pa.ipc.new_file(sink, schema, options=pa.ipc.IpcWriteOptions(compression=self.compression))
+        return pa.RecordBatchFileWriter(sink, schema)
+
+    def write_chunks(self, chunks, name):
+        """ Write an iterable of frames as record batches of the frame name, returns the number of rows """
+        path = self._prepare(name)
+        schema = None
+        writer = None
+        rows = 0
+        with pa.OSFile(path + '.tmp', 'wb') as sink:
+            try:
+                for df in chunks:
+                    # without a schema of the frame later chunks are cast to the first chunk's
+                    table = self._table(df, name, schema)
+                    if writer is None:
+                        schema = table.schema
+                        writer = self._file_writer(sink, schema)
+                    writer.write_table(table)
+                    rows += len(df)
+            finally:
+                if writer is not None:
+                    writer.close()
+        if writer is None:
+            os.remove(path + '.tmp')
+            raise ValueError(f"no frames to write to {name}")
+        os.replace(path + '.tmp', path)
+        self._record('written', name, rows)
+        return rows
+
+    def read(self, name, columns=None):
+        table = feather.read_table(self.path(name), columns=columns, memory_map=self.memory_map)
+        # one block per column lets uncompressed, mapped columns be used without a copy
+        df = table.to_pandas(split_blocks=True)
+        self._record('read', name, len(df))
+        return df
+
+    def read_chunks(self, name, columns=None, chunksize=None):
+        """ Read the frame name one record batch at a time, the batches are as they were written """
+        rows = 0
+        with pa.memory_map(self.path(name)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                df = reader.get_batch(i).to_pandas()
+                rows += len(df)
+                yield df if columns is None else df[columns]
+        self._record('read', name, rows)
+
+    def schema(self, name):
+        """ Return the arrow schema of a stored frame without reading its data """
+        with pa.memory_map(self.path(name)) as source:
+            return pa.ipc.open_file(source).schema
+
+
+class SessionStorage(object):
+    """ Keeps the frames written in this session in memory for the stages that read them next
+
+        Reads of a frame written earlier in the session return the same object,
+        without a copy, so stages must not modify frames after writing them or
+        frames they have read. Frames not written in the session are read from
+        the backing storage. With persist a copy of every frame is also written
+        to the backing storage in the background (write-behind), in the order
+        they were written, so changing a frame after writing it does not change
+        what is persisted. A failed background write is raised by the next read
+        or write, or by flush, which waits for the writes.
+    """
+    # a StageMetrics that counts the rows of every read and write
+    metrics = None
+
+    def __init__(self, backing, persist=True):
+        self.backing = backing
+        self.persist = persist
+        self.frames = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        # a single writer keeps the writes of one name in order
+        self.writer = ThreadPoolExecutor(max_workers=1) if persist else None
+
+    def path(self, name):
+        return self.backing.path(name)
+
+    def exists(self, name):
+        return name in self.frames or self.backing.exists(name)
+
+    def remove(self, name):
+        # a pending write would bring the file back
+        self.flush()
+        self.frames.pop(name, None)
+        if self.backing.exists(name):
+            self.backing.remove(name)
+
+    def _raise_failed_writes(self):
+        """ Raise the first background write that failed, forgetting the ones that are done """
+        with self.lock:
+            done = [future for future in self.pending if future.done()]
+            self.pending = [future for future in self.pending if not future.done()]
+        for future in done:
+            future.result()
+
+    def write(self, df, name):
+        self._raise_failed_writes()
+        self.frames[name] = df
+        if self.metrics is not None:
+            self.metrics.record_io('written', len(df), 0)
+        if self.persist:
+            with self.lock:
+                self.pending.append(self.writer.submit(self.backing.write, df.copy(), name))
+
+    def write_chunks(self, chunks, name):
+        # streamed frames are too big to keep in memory, they are written straight to the backing storage
+        self.flush()
+        self.frames.pop(name, None)
+        return self.backing.write_chunks(chunks, name)
+
+    def read_chunks(self, name, columns=None, chunksize=100000):
+        self._raise_failed_writes()
+        if name in self.frames:
+            return iter([self.read(name, columns=columns)])
+        return self.backing.read_chunks(name, columns=columns, chunksize=chunksize)
+
+    def read(self, name, columns=None):
+        self._raise_failed_writes()
+        df = self.frames.get(name)
+        if df is None:
+            return self.backing.read(name, columns=columns)
+        if self.metrics is not None:
+            self.metrics.record_io('read', len(df), 0)
+        return df if columns is None else df[columns]
+
+    def flush(self):
+        """ Wait until every frame written so far is persisted """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+
+STORAGE_BACKENDS = {
+    'csv': CsvStorage,
+    'arrow': ArrowStorage,
+}
 
 
 class ProcessDMA():
-    def __init__(self, data_directory):
+    # population columns used by the denominator
+    DENOMINATOR_POPULATION_COLUMNS = [
+        'dma', 'col_pop_2010', 'col_hh_med_income', 'col_hh_avg_income', 'col_median_age', 'col_hu_med_rent',
+        'col_hu_med_home_value', 'col_attained_no_high_school', 'col_attained_some_high_school',
+        'col_attained_high_school_graduate', 'col_attained_some_college', 'col_attained_associates',
+        'col_attained_bachelors', 'col_attained_graduate_professional', 'col_white', 'col_hispanic', 'col_black',
+        'col_indian', 'col_asian', 'col_hu_owner_occ', 'col_hu_renter_occ', 'col_hu_occupied', 'col_in_college']
+
+    def __init__(self, data_directory, storage='csv', incremental=False, census=None, metrics=None, session=False,
+                 persist=True):
         self.data_directory = data_directory
+        # intermediate frames are persisted through a storage backend, by name or instance
+        if isinstance(storage, str):
+            storage = STORAGE_BACKENDS[storage](data_directory)
+        # census tables (population, zip_dma, dma_population) can be shared between data directories
+        if census is None:
+            census = storage
+        # keep the numerator partitioned by month and only rebuild months whose aggregates changed
+        self.incremental = incremental
+        # optional StageMetrics recording time, memory, rows and bytes of every stage
+        self.metrics = metrics
+        if metrics is not None:
+            storage.metrics = metrics
+            census.metrics = metrics
+
+        # in a session stages hand their frames to each other in memory, persist writes them behind
+        if session:
+            session_storage = SessionStorage(storage, persist=persist)
+            census = session_storage if census is storage else SessionStorage(census, persist=persist)
+            storage = session_storage
+            storage.metrics = census.metrics = metrics
+        self.session = session
+        self.storage = storage
+        self.census = census
         self.strt_dt = datetime.date(2018, 2, 1)
         self.end_dt = datetime.date.today()
 
+    @instrumented_stage
     def process_population(self, population):
         # add leading zeros to zip codes
-        population['zip'] = population['zip'].apply(lambda x: x.zfill(5))
+        zip_codes = normalize_zip(population['zip'], pad=True)
+        population['zip'] = np.where(zip_codes >= 0, format_zip(zip_codes), population['zip'])
 
         # fix dma code for one record
         population.loc[population.zip == "98225", ['dma_cd']] = "819"
@@ -25,21 +805,12 @@ class ProcessDMA():
         # list of household income columns
         hh_income_list = [col for col in population.columns if col.startswith('col_hh')]
 
-        # list of other columns to turn into ints
+        # list of other columns to turn into numbers
         feature_cols_list = list(population.columns[27:])
 
-        # change data types from obj to int
-        for col in female_pop_list:
-            population[col] = population[col].astype(str).astype(int)
-
-        for col in hh_income_list:
-            population[col] = population[col].astype(str).astype(int)
-
-        for col in feature_cols_list:
-            population[col] = population[col].astype(str).astype(float)
-
-        population['total_female_pop'] = population['total_female_pop'].astype(str).astype(float)
-        population['col_pop_2010'] = population['col_pop_2010'].astype(str).astype(float)
+        # change data types from obj to the narrowest numeric types and dma codes to categories
+        numeric_cols = female_pop_list + hh_income_list + feature_cols_list + ['total_female_pop', 'col_pop_2010']
+        ingest_frame(population, numeric_cols, categorical_cols=['dma', 'dma_cd'])
 
         # get population total of women ages 20-64
         # TODO ask SHannon about the columns 20-64 when there are columnns from age 24 - 74
@@ -69,254 +840,185 @@ class ProcessDMA():
         # get table of zips tagged to dma
         zip_dma = population[['zip', 'dma', 'dma_cd']]
         # exporting the dataframes to csv
-        population.to_csv(os.path.join(self.data_directory, 'population.csv'), sep='|', index=False,
-                          encoding='utf-8', quoting=1)
-        zip_dma.to_csv(os.path.join(self.data_directory, 'zip_dma.csv'), sep='|', index=False,
-                       encoding='utf-8', quoting=1)
-        dma_population.to_csv(os.path.join(self.data_directory, 'dma_population.csv'), sep='|', index=False,
-                              encoding='utf-8', quoting=1)
+        self.census.write(population, 'population')
+        self.census.write(zip_dma, 'zip_dma')
+        self.census.write(dma_population, 'dma_population')
 
+    @instrumented_stage
     def process_ship_zip_dma(self, ship_zip):
-        zip_dma = pd.read_csv(os.path.join(self.data_directory, 'zip_dma.csv'), sep='|', quotechar='"')
-        ship_zip['zip_clean'] = np.where(ship_zip['zip'].str.len() == 5,
-                                         ship_zip['zip'],
-                                         ship_zip['zip'].str[:5])
+        zip_index = ZipDmaIndex(self.census.read('zip_dma'))
+        cust_dmas = tag_ship_zip(ship_zip, zip_index)
+        self.storage.write(cust_dmas, 'cust_dmas')
 
-        # drop small amount of zips coded as 'n/a'
-        ship_zip.drop(ship_zip[ship_zip.zip_clean == 'n/a'].index, inplace=True)
+    @instrumented_stage
+    def process_ship_zip_dma_chunks(self, chunks, chunksize=100000):
+        """ Streaming process_ship_zip_dma for customer tables that do not fit in memory
 
-        # drop zip with weird characters (anything that not a number)
-        ship_zip.drop(ship_zip[ship_zip.zip_clean.str.contains('[^0-9]', regex=True)].index, inplace=True)
+            chunks is an iterable of ship_zip frames, like read_csv or read_sql
+            with a chunksize, or the path of a pipe delimited ship_zip csv to
+            read chunksize rows at a time. Every chunk is tagged and appended to
+            cust_dmas as it comes, so memory is bounded by the chunk size.
+        """
+        path = None
+        if isinstance(chunks, str):
+            path = chunks
+            chunks = pd.read_csv(path, sep='|', quotechar='"', dtype={'zip': str}, chunksize=chunksize)
+        zip_index = ZipDmaIndex(self.census.read('zip_dma'))
 
-        # drop zip column no longer used
-        ship_zip = ship_zip.drop(['zip'], axis=1)
+        def tagged():
+            empty = True
+            for ship_zip in chunks:
+                empty = False
+                if self.metrics is not None:
+                    self.metrics.record_io('read', len(ship_zip), 0)
+                yield tag_ship_zip(ship_zip, zip_index)
+            # an empty source still writes cust_dmas, with just the header
+            if empty:
+                yield tag_ship_zip(pd.DataFrame(columns=SHIP_ZIP_COLUMNS), zip_index)
 
-        # converting the zip field in  zip_dma to object
-        zip_dma.zip = zip_dma.zip.astype(str)
+        rows = self.storage.write_chunks(tagged(), 'cust_dmas')
+        if path is not None and self.metrics is not None:
+            self.metrics.record_io('read', 0, os.path.getsize(path))
+        logging.info(f"{rows} customers tagged with a dma")
 
-        # attach dma to zip
-        ship_zip_dma = ship_zip.merge(zip_dma, left_on='zip_clean', right_on='zip', how='left')
+    @instrumented_stage
+    def aggregate_customers(self, sources=None, merge=False, max_workers=1, chunksize=100000):
+        """ Build prospects_agg.csv and shoppers_agg.csv from tagged customers, instead of the external query
 
-        # drop customers with zips not on census data
-        ship_zip_dma.drop(ship_zip_dma[ship_zip_dma.dma.isnull()].index, inplace=True)
+            By default the stored cust_dmas is streamed. sources can instead be
+            an iterable of cust_dmas like frames, or a list of cust_dmas csv
+            paths that are counted in parallel on max_workers processes. With
+            merge the counts are added to the ones kept from earlier runs, so
+            only customers that are new since then need to be passed; merge
+            needs those sources, the stored cust_dmas would be counted twice.
+        """
+        if merge and sources is None:
+            raise ValueError('merge needs the sources of the new customers, cust_dmas is already counted')
+        counts = MonthDmaCounts()
+        if merge and self.storage.exists('customer_counts'):
+            counts = MonthDmaCounts.from_frame(self.storage.read('customer_counts'))
 
-        # clean up data
-        cust_dmas = ship_zip_dma[
-            ['customer_key', 'first_order_month', 'zip_clean', 'dma', 'dma_cd', 'lifetime_net_amount', 'total_orders']]
+        if sources is None:
+            sources = self.storage.read_chunks('cust_dmas', columns=COUNT_COLUMNS, chunksize=chunksize)
+        if isinstance(sources, (list, tuple)) and all(isinstance(source, str) for source in sources):
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                for file_counts in pool.map(count_customers_csv, sources, [chunksize] * len(sources)):
+                    counts.merge(file_counts)
+        else:
+            for customers in sources:
+                counts.update(customers)
 
-        cust_dmas.to_csv(os.path.join(self.data_directory, 'cust_dmas.csv'), sep='|', index=False,
-                         encoding='utf-8', quoting=1)
+        self.storage.write(counts.to_frame(), 'customer_counts')
+        for name, aggregate in zip(['prospects_agg', 'shoppers_agg'], counts.aggregates()):
+            self._write_external(name, aggregate)
+        logging.info(f"customer counts ready for {len(counts.counts)} type, month and dma keys")
 
+    @instrumented_stage
     def numerator2(self):
-        prospects_agg = pd.read_csv(os.path.join(self.data_directory, 'prospects_agg.csv'), sep='|', quotechar='"')
-        shoppers_agg = pd.read_csv(os.path.join(self.data_directory, 'shoppers_agg.csv'), sep='|', quotechar='"')
+        prospects_agg = self._read_external('prospects_agg')
+        shoppers_agg = self._read_external('shoppers_agg')
         prospects_agg.columns = ['month', 'dma', 'count']
-        prospects_agg['cust_type'] = 'Prospects Only'
-
         shoppers_agg.columns = ['month', 'dma', 'count']
-        shoppers_agg['cust_type'] = 'Shoppers Only'
-
-        numerator = pd.concat([shoppers_agg, prospects_agg])
-
-        numerator = numerator[numerator['count'] > 0]
-
-        numerator_both = numerator.groupby(['month', 'dma']).sum().reset_index()
-        numerator_both['cust_type'] = 'Shoppers + Prospects'
-
-        numerator2 = pd.concat([numerator, numerator_both])
-
-        numerator2 = numerator2.sort_values(['month', 'dma'])
-
-        # change null dma names to DMA not found
-        numerator2.loc[numerator2['dma'].isnull(), 'dma'] = "DMA Not Found"
-
-        numerator2.loc[numerator2['dma'] == 'Albany et al, NY', 'dma'] = 'Albany-Schenectady-Troy, NY'
-        numerator2.loc[numerator2['dma'] == 'Albany et al, NY', 'dma'] = 'Albany-Schenectady-Troy, NY'
-        numerator2.loc[numerator2['dma'] == 'Birmingham et al, AL', 'dma'] = 'Birmingham (Anniston and Tuscaloosa), AL'
-        numerator2.loc[numerator2['dma'] == 'Bluefield et al, WV', 'dma'] = 'Bluefield-Beckley-Oak Hill, WV'
-        numerator2.loc[numerator2['dma'] == 'Boston et al, MA-NH', 'dma'] = 'Boston, MA (Manchester, NH)'
-        numerator2.loc[numerator2['dma'] == 'Burlington et al, VT-NY', 'dma'] = 'Burlington, VT-Plattsburgh, NY'
-        numerator2.loc[
-            numerator2['dma'] == 'Cedar Rapids et al, IA', 'dma'] = 'Cedar Rapids-Waterloo-Iowa City & Dubuque, IA'
-        numerator2.loc[numerator2['dma'] == 'Champaign et al, IL', 'dma'] = 'Champaign & Springfield-Decatur, IL'
-        numerator2.loc[numerator2['dma'] == 'Charleston et al, WV', 'dma'] = 'Charleston-Huntington, WV'
-        numerator2.loc[numerator2['dma'] == 'Cheyenne et al, WY-NE', 'dma'] = 'Cheyenne, WY-Scottsbluff, NE'
-        numerator2.loc[numerator2['dma'] == 'Cleveland et al, OH', 'dma'] = 'Cleveland-Akron (Canton), OH'
-        numerator2.loc[numerator2['dma'] == 'Colorado Sprgs et al, CO', 'dma'] = 'Colorado Springs-Pueblo, CO'
-        numerator2.loc[numerator2['dma'] == 'Columbia et al, MO', 'dma'] = 'Columbia-Jefferson City, MO'
-        numerator2.loc[numerator2['dma'] == 'Columbus et al, MS', 'dma'] = 'Columbus-Tupelo-West Point, MS'
-        numerator2.loc[numerator2['dma'] == 'Davenport et al, IA-IL', 'dma'] = 'Davenport, IA-Rock Island-Moline, IL'
-        numerator2.loc[numerator2['dma'] == 'Duluth-Superior, MN-WI', 'dma'] = 'Duluth, MN-Superior, WI'
-        numerator2.loc[numerator2['dma'] == 'El Paso et al, TX-NM', 'dma'] = 'El Paso, TX'
-        numerator2.loc[numerator2['dma'] == 'Elmira et al, NY', 'dma'] = 'Elmira, NY'
-        numerator2.loc[numerator2['dma'] == 'Flint-Saginaw et al, MI', 'dma'] = 'Flint-Saginaw-Bay City, MI'
-        numerator2.loc[
-            numerator2['dma'] == 'Ft. Smith et al, AR', 'dma'] = 'Ft. Smith-Fayetteville-Springdale-Rogers, AR'
-        numerator2.loc[numerator2['dma'] == 'Grand Junction et al, CO', 'dma'] = 'Grand Junction-Montrose, CO'
-        numerator2.loc[numerator2['dma'] == 'Grand Rapids et al, MI', 'dma'] = 'Grand Rapids-Kalamazoo-Battle Creek, MI'
-        numerator2.loc[numerator2['dma'] == 'Greensboro et al, NC', 'dma'] = 'Greensboro-High Point-Winston Salem, NC'
-        numerator2.loc[numerator2['dma'] == 'Greenville et al, NC', 'dma'] = 'Greenville-New Bern-Washington, NC'
-        numerator2.loc[numerator2['dma'] == 'Greenville et al, SC-NC', 'dma'] = f"""Greenville-Spartanburg,
-        SC-Asheville, NC-Anderson,SC""".replace("\n", "")
-        numerator2.loc[numerator2['dma'] == 'Harlingen et al, TX', 'dma'] = 'Harlingen-Weslaco-Brownsville-McAllen, TX'
-        numerator2.loc[numerator2['dma'] == 'Harrisburg et al, PA', 'dma'] = 'Harrisburg-Lancaster-Lebanon-York, PA'
-        numerator2.loc[numerator2['dma'] == 'Huntsville et al, AL', 'dma'] = 'Huntsville-Decatur (Florence), AL'
-        numerator2.loc[numerator2['dma'] == 'Idaho Falls et al, ID', 'dma'] = 'Idaho Falls-Pocatello, ID'
-        numerator2.loc[numerator2['dma'] == 'Joplin-Pittsburg, MO-KS', 'dma'] = 'Joplin, MO-Pittsburg, KS'
-        numerator2.loc[numerator2['dma'] == 'Kansas City, MO-KS', 'dma'] = 'Kansas City, MO'
-        numerator2.loc[numerator2['dma'] == 'Lincoln et al, NE', 'dma'] = 'Lincoln & Hastings-Kearney, NE'
-        numerator2.loc[numerator2['dma'] == 'Little Rock et al, AR', 'dma'] = 'Little Rock-Pine Bluff, AR'
-        numerator2.loc[numerator2['dma'] == 'Medford et al, OR', 'dma'] = 'Medford-Klamath Falls, OR'
-        numerator2.loc[numerator2['dma'] == 'Miami-Ft. Lauderdale, FL', 'dma'] = 'Miami-Fort Lauderdale, FL'
-        numerator2.loc[numerator2['dma'] == 'Minot et al, ND', 'dma'] = 'Minot-Bismarck-Dickinson(Williston), ND'
-        numerator2.loc[
-            numerator2['dma'] == 'Mobile et al, AL-FL', 'dma'] = 'Mobile, AL-Pensacola (Ft. Walton Beach), FL'
-        numerator2.loc[numerator2['dma'] == 'Monroe-El Dorado, LA-AR', 'dma'] = 'Monroe, LA-El Dorado, AR'
-        numerator2.loc[numerator2['dma'] == 'Myrtle Beach et al, SC', 'dma'] = 'Myrtle Beach-Florence, SC'
-        numerator2.loc[numerator2['dma'] == 'Norfolk et al, VA', 'dma'] = 'Norfolk-Portsmouth-Newport News, VA'
-        numerator2.loc[numerator2['dma'] == 'Orlando et al, FL', 'dma'] = 'Orlando-Daytona Beach-Melbourne, FL'
-        numerator2.loc[numerator2['dma'] == 'Ottumwa et al, IA-MO', 'dma'] = 'Ottumwa, IA-Kirksville, MO'
-        numerator2.loc[
-            numerator2['dma'] == 'Paducah et al, KY-MO-IL', 'dma'] = 'Paducah, KY-Cape Girardeau, MO-Harrisburg, IL'
-        numerator2.loc[numerator2['dma'] == 'Phoenix et al, AZ', 'dma'] = 'Phoenix, AZ'
-        numerator2.loc[numerator2['dma'] == 'Providence et al, RI-MA', 'dma'] = 'Providence, RI-New Bedford, MA'
-        numerator2.loc[numerator2['dma'] == 'Quincy et al, IL-MO-IA', 'dma'] = 'Quincy, IL-Hannibal, MO-Keokuk, IA'
-        numerator2.loc[numerator2['dma'] == 'Raleigh et al, NC', 'dma'] = 'Raleigh-Durham (Fayetteville), NC'
-        numerator2.loc[numerator2['dma'] == 'Rochester et al, MN-IA', 'dma'] = 'Rochester, MN-Mason City, IA-Austin, MN'
-        numerator2.loc[numerator2['dma'] == 'Sacramento et al, CA', 'dma'] = 'Sacramento-Stockton-Modesto, CA'
-        numerator2.loc[numerator2['dma'] == 'San Francisco et al, CA', 'dma'] = 'San Francisco-Oakland-San Jose, CA'
-        numerator2.loc[
-            numerator2['dma'] == 'Santa Barbara et al, CA', 'dma'] = 'Santa Barbara-Santa Maria-San Luis Obispo, CA'
-        numerator2.loc[numerator2['dma'] == 'Sherman-Ada, TX-OK', 'dma'] = 'Sherman, TX-Ada, OK'
-        numerator2.loc[numerator2['dma'] == 'Sioux Falls et al, SD', 'dma'] = 'Sioux Falls (Mitchell), SD'
-        numerator2.loc[numerator2['dma'] == 'Tallahassee et al, FL-GA', 'dma'] = 'Tallahassee, FL-Thomasville, GA'
-        numerator2.loc[numerator2['dma'] == 'Tampa et al, FL', 'dma'] = 'Tampa-St. Petersburg (Sarasota), FL'
-        numerator2.loc[numerator2['dma'] == 'Traverse City et al, MI', 'dma'] = 'Traverse City-Cadillac, MI'
-        numerator2.loc[numerator2['dma'] == 'Tucson(Sierra Vista), AZ', 'dma'] = 'Tucson (Sierra Vista), AZ'
-        numerator2.loc[
-            numerator2['dma'] == 'Tyler-Longview et al, TX', 'dma'] = 'Tyler-Longview(Lufkin & Nacogdoches), TX'
-        numerator2.loc[numerator2['dma'] == 'W. Palm Beach et al, FL', 'dma'] = 'West Palm Beach-Ft. Pierce, FL'
-        numerator2.loc[numerator2['dma'] == 'Washington et al, DC-MD', 'dma'] = 'Washington, DC (Hagerstown, MD)'
-        numerator2.loc[numerator2['dma'] == 'Wheeling et al, WV-OH', 'dma'] = 'Wheeling, WV-Steubenville, OH'
-        numerator2.loc[numerator2['dma'] == 'Wichita Fls et al, TX-OK', 'dma'] = 'Wichita Falls, TX-Lawton, OK'
-        numerator2.loc[numerator2['dma'] == 'Wichita et al, KS', 'dma'] = 'Wichita-Hutchinson, KS Plus'
-        numerator2.loc[numerator2['dma'] == 'Wilkes Barre et al, PA', 'dma'] = 'Wilkes Barre-Scranton, PA'
-        numerator2.loc[numerator2['dma'] == 'Yakima et al, WA', 'dma'] = 'Yakima-Pasco-Richland-Kennewick, WA'
-        numerator2.loc[numerator2['dma'] == 'Yuma-El Centro, AZ-CA', 'dma'] = 'Yuma, AZ-El Centro, CA'
-
-        numerator2['last_update_datetime'] = datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-        numerator2['last_update_datetime'] = pd.to_datetime(numerator2['last_update_datetime'],
-                                                            format="%m/%d/%Y %H:%M:%S")
 
+        if self.incremental:
+            self._numerator2_partitions(prospects_agg, shoppers_agg)
+            return
+
+        numerator2 = build_numerator(prospects_agg, shoppers_agg)
         logging.info("numerator file ready")
 
         # output numerator file
-        numerator2.to_csv(os.path.join(self.data_directory, 'numerator2.csv'), sep='|', index=False,
-                          encoding='utf-8')
+        self.storage.write(numerator2, 'numerator2')
+
+    def _read_external(self, name):
+        """ Read one of the aggregate csv files exported into the data directory """
+        path = os.path.join(self.data_directory, name + '.csv')
+        df = pd.read_csv(path, sep='|', quotechar='"')
+        if self.metrics is not None:
+            self.metrics.record_io('read', len(df), os.path.getsize(path))
+        return df
+
+    def _write_external(self, name, df):
+        """ Write one of the aggregate csv files numerator2 reads from the data directory """
+        path = os.path.join(self.data_directory, name + '.csv')
+        df.to_csv(path, sep='|', index=False, encoding='utf-8')
+        if self.metrics is not None:
+            self.metrics.record_io('written', len(df), os.path.getsize(path))
+
+    def _numerator2_partitions(self, prospects_agg, shoppers_agg):
+        """ Rebuild the numerator2 month partitions whose prospects or shoppers rows, or the code, changed """
+        if self.storage.exists('numerator2/_partitions'):
+            partitions = self.storage.read('numerator2/_partitions')
+            known = dict(zip(partitions['partition'].astype(str), partitions['digest']))
+        else:
+            known = {}
+
+        prospects_keys = month_partitions(prospects_agg['month'])
+        shoppers_keys = month_partitions(shoppers_agg['month'])
+        code_digest = numerator_code_digest()
+        digests = {}
+        rebuilt = 0
+        for partition in sorted(set(prospects_keys) | set(shoppers_keys)):
+            prospects = prospects_agg[prospects_keys == partition]
+            shoppers = shoppers_agg[shoppers_keys == partition]
+            digests[partition] = code_digest + rows_digest(prospects) + rows_digest(shoppers)
+            if known.get(partition) == digests[partition] and self.storage.exists('numerator2/' + partition):
+                continue
+            self.storage.write(build_numerator(prospects, shoppers), 'numerator2/' + partition)
+            rebuilt += 1
+
+        # months that are no longer in the aggregates
+        for partition in set(known) - set(digests):
+            if self.storage.exists('numerator2/' + partition):
+                self.storage.remove('numerator2/' + partition)
+
+        self.storage.write(pd.DataFrame({'partition': list(digests), 'digest': list(digests.values())}),
+                           'numerator2/_partitions')
+        logging.info(f"numerator partitions ready, rebuilt {rebuilt} of {len(digests)} months")
+
+    def read_numerator2(self, strt_dt=None, end_dt=None, columns=None, all_months=False):
+        """ Numerator rows for the months in [strt_dt, end_dt], by default the ProcessDMA date range
+
+            With all_months every month is read, whatever its date. In
+            incremental mode only the partitions of the months are read.
+        """
+        first = (strt_dt or self.strt_dt).strftime('%Y-%m')
+        last = (end_dt or self.end_dt).strftime('%Y-%m')
+        if not self.incremental:
+            numerator2 = self.storage.read('numerator2', columns=columns)
+            if all_months:
+                return numerator2
+            keys = month_partitions(numerator2['month'])
+            return numerator2[(keys >= first) & (keys <= last)]
+
+        partitions = self.storage.read('numerator2/_partitions', columns=['partition'])['partition'].astype(str)
+        frames = [self.storage.read('numerator2/' + partition, columns=columns)
+                  for partition in sorted(partitions) if all_months or first <= partition <= last]
+        if not frames:
+            return pd.DataFrame(columns=columns or ['month', 'dma', 'count', 'cust_type', 'last_update_datetime'])
+        return pd.concat(frames, ignore_index=True)
 
     def weighted_average(self, df, data_col, weight_col, by_col):
-        df['_data_times_weight'] = df[data_col] * df[weight_col]
-        df['_weight_where_notnull'] = df[weight_col] * pd.notnull(df[data_col])
-        g = df.groupby(by_col)
-        result = g['_data_times_weight'].sum() / g['_weight_where_notnull'].sum()
-        del df['_data_times_weight'], df['_weight_where_notnull']
-        result2 = pd.DataFrame(result).reset_index()
-        result3 = result2.rename(columns={0: 'w_avg_' + data_col})
-        return result3
-
-    def final_denominator(self):
-        population = pd.read_csv(os.path.join(self.data_directory, 'population.csv'), sep='|', quotechar='"')
-        dma_population = pd.read_csv(os.path.join(self.data_directory, 'dma_population.csv'), sep='|', quotechar='"')
-        numerator2 = pd.read_csv(os.path.join(self.data_directory, 'numerator2.csv'), sep='|', quotechar='"')
-        dma_population.columns = ['dma', 'count_pop']
-
-        dma_population.loc[dma_population['dma'] == 'Albany et al, NY', 'dma'] = 'Albany-Schenectady-Troy, NY'
-        dma_population.loc[dma_population['dma'] == 'Albany et al, NY', 'dma'] = 'Albany-Schenectady-Troy, NY'
-        dma_population.loc[
-            dma_population['dma'] == 'Birmingham et al, AL', 'dma'] = 'Birmingham (Anniston and Tuscaloosa), AL'
-        dma_population.loc[dma_population['dma'] == 'Bluefield et al, WV', 'dma'] = 'Bluefield-Beckley-Oak Hill, WV'
-        dma_population.loc[dma_population['dma'] == 'Boston et al, MA-NH', 'dma'] = 'Boston, MA (Manchester, NH)'
-        dma_population.loc[dma_population['dma'] == 'Burlington et al, VT-NY', 'dma'] = 'Burlington, VT-Plattsburgh, NY'
-        dma_population.loc[
-            dma_population['dma'] == 'Cedar Rapids et al, IA', 'dma'] = 'Cedar Rapids-Waterloo-Iowa City & Dubuque, IA'
-        dma_population.loc[
-            dma_population['dma'] == 'Champaign et al, IL', 'dma'] = 'Champaign & Springfield-Decatur, IL'
-        dma_population.loc[dma_population['dma'] == 'Charleston et al, WV', 'dma'] = 'Charleston-Huntington, WV'
-        dma_population.loc[dma_population['dma'] == 'Cheyenne et al, WY-NE', 'dma'] = 'Cheyenne, WY-Scottsbluff, NE'
-        dma_population.loc[dma_population['dma'] == 'Cleveland et al, OH', 'dma'] = 'Cleveland-Akron (Canton), OH'
-        dma_population.loc[dma_population['dma'] == 'Colorado Sprgs et al, CO', 'dma'] = 'Colorado Springs-Pueblo, CO'
-        dma_population.loc[dma_population['dma'] == 'Columbia et al, MO', 'dma'] = 'Columbia-Jefferson City, MO'
-        dma_population.loc[dma_population['dma'] == 'Columbus et al, MS', 'dma'] = 'Columbus-Tupelo-West Point, MS'
-        dma_population.loc[
-            dma_population['dma'] == 'Davenport et al, IA-IL', 'dma'] = 'Davenport, IA-Rock Island-Moline, IL'
-        dma_population.loc[dma_population['dma'] == 'Duluth-Superior, MN-WI', 'dma'] = 'Duluth, MN-Superior, WI'
-        dma_population.loc[dma_population['dma'] == 'El Paso et al, TX-NM', 'dma'] = 'El Paso, TX'
-        dma_population.loc[dma_population['dma'] == 'Elmira et al, NY', 'dma'] = 'Elmira, NY'
-        dma_population.loc[dma_population['dma'] == 'Flint-Saginaw et al, MI', 'dma'] = 'Flint-Saginaw-Bay City, MI'
-        dma_population.loc[
-            dma_population['dma'] == 'Ft. Smith et al, AR', 'dma'] = 'Ft. Smith-Fayetteville-Springdale-Rogers, AR'
-        dma_population.loc[dma_population['dma'] == 'Grand Junction et al, CO', 'dma'] = 'Grand Junction-Montrose, CO'
-        dma_population.loc[
-            dma_population['dma'] == 'Grand Rapids et al, MI', 'dma'] = 'Grand Rapids-Kalamazoo-Battle Creek, MI'
-        dma_population.loc[
-            dma_population['dma'] == 'Greensboro et al, NC', 'dma'] = 'Greensboro-High Point-Winston Salem, NC'
-        dma_population.loc[
-            dma_population['dma'] == 'Greenville et al, NC', 'dma'] = 'Greenville-New Bern-Washington, NC'
-        dma_population.loc[dma_population['dma'] == 'Greenville et al, SC-NC', 'dma'] = f"""Greenville-Spartanburg,
-        SC-Asheville, NC-Anderson,SC""".replace("\n", "")
-        dma_population.loc[
-            dma_population['dma'] == 'Harlingen et al, TX', 'dma'] = 'Harlingen-Weslaco-Brownsville-McAllen, TX'
-        dma_population.loc[
-            dma_population['dma'] == 'Harrisburg et al, PA', 'dma'] = 'Harrisburg-Lancaster-Lebanon-York, PA'
-        dma_population.loc[dma_population['dma'] == 'Huntsville et al, AL', 'dma'] = 'Huntsville-Decatur (Florence), AL'
-        dma_population.loc[dma_population['dma'] == 'Idaho Falls et al, ID', 'dma'] = 'Idaho Falls-Pocatello, ID'
-        dma_population.loc[dma_population['dma'] == 'Joplin-Pittsburg, MO-KS', 'dma'] = 'Joplin, MO-Pittsburg, KS'
-        dma_population.loc[dma_population['dma'] == 'Kansas City, MO-KS', 'dma'] = 'Kansas City, MO'
-        dma_population.loc[dma_population['dma'] == 'Lincoln et al, NE', 'dma'] = 'Lincoln & Hastings-Kearney, NE'
-        dma_population.loc[dma_population['dma'] == 'Little Rock et al, AR', 'dma'] = 'Little Rock-Pine Bluff, AR'
-        dma_population.loc[dma_population['dma'] == 'Medford et al, OR', 'dma'] = 'Medford-Klamath Falls, OR'
-        dma_population.loc[dma_population['dma'] == 'Miami-Ft. Lauderdale, FL', 'dma'] = 'Miami-Fort Lauderdale, FL'
-        dma_population.loc[
-            dma_population['dma'] == 'Minot et al, ND', 'dma'] = 'Minot-Bismarck-Dickinson(Williston), ND'
-        dma_population.loc[
-            dma_population['dma'] == 'Mobile et al, AL-FL', 'dma'] = 'Mobile, AL-Pensacola (Ft. Walton Beach), FL'
-        dma_population.loc[dma_population['dma'] == 'Monroe-El Dorado, LA-AR', 'dma'] = 'Monroe, LA-El Dorado, AR'
-        dma_population.loc[dma_population['dma'] == 'Myrtle Beach et al, SC', 'dma'] = 'Myrtle Beach-Florence, SC'
-        dma_population.loc[dma_population['dma'] == 'Norfolk et al, VA', 'dma'] = 'Norfolk-Portsmouth-Newport News, VA'
-        dma_population.loc[dma_population['dma'] == 'Orlando et al, FL', 'dma'] = 'Orlando-Daytona Beach-Melbourne, FL'
-        dma_population.loc[dma_population['dma'] == 'Ottumwa et al, IA-MO', 'dma'] = 'Ottumwa, IA-Kirksville, MO'
-        dma_population.loc[
-            dma_population['dma'] == 'Paducah et al, KY-MO-IL', 'dma'] = 'Paducah, KY-Cape Girardeau, MO-Harrisburg, IL'
-        dma_population.loc[dma_population['dma'] == 'Phoenix et al, AZ', 'dma'] = 'Phoenix, AZ'
-        dma_population.loc[dma_population['dma'] == 'Providence et al, RI-MA', 'dma'] = 'Providence, RI-New Bedford, MA'
-        dma_population.loc[
-            dma_population['dma'] == 'Quincy et al, IL-MO-IA', 'dma'] = 'Quincy, IL-Hannibal, MO-Keokuk, IA'
-        dma_population.loc[dma_population['dma'] == 'Raleigh et al, NC', 'dma'] = 'Raleigh-Durham (Fayetteville), NC'
-        dma_population.loc[
-            dma_population['dma'] == 'Rochester et al, MN-IA', 'dma'] = 'Rochester, MN-Mason City, IA-Austin, MN'
-        dma_population.loc[dma_population['dma'] == 'Sacramento et al, CA', 'dma'] = 'Sacramento-Stockton-Modesto, CA'
-        dma_population.loc[
-            dma_population['dma'] == 'San Francisco et al, CA', 'dma'] = 'San Francisco-Oakland-San Jose, CA'
-        dma_population.loc[
-            dma_population['dma'] == 'Santa Barbara et al, CA', 'dma'] = 'Santa Barbara-Santa Maria-San Luis Obispo, CA'
-        dma_population.loc[dma_population['dma'] == 'Sherman-Ada, TX-OK', 'dma'] = 'Sherman, TX-Ada, OK'
-        dma_population.loc[dma_population['dma'] == 'Sioux Falls et al, SD', 'dma'] = 'Sioux Falls (Mitchell), SD'
-        dma_population.loc[
-            dma_population['dma'] == 'Tallahassee et al, FL-GA', 'dma'] = 'Tallahassee, FL-Thomasville, GA'
-        dma_population.loc[dma_population['dma'] == 'Tampa et al, FL', 'dma'] = 'Tampa-St. Petersburg (Sarasota), FL'
-        dma_population.loc[dma_population['dma'] == 'Traverse City et al, MI', 'dma'] = 'Traverse City-Cadillac, MI'
-        dma_population.loc[dma_population['dma'] == 'Tucson(Sierra Vista), AZ', 'dma'] = 'Tucson (Sierra Vista), AZ'
-        dma_population.loc[
-            dma_population['dma'] == 'Tyler-Longview et al, TX', 'dma'] = 'Tyler-Longview(Lufkin & Nacogdoches), TX'
-        dma_population.loc[dma_population['dma'] == 'W. Palm Beach et al, FL', 'dma'] = 'West Palm Beach-Ft. Pierce, FL'
-        dma_population.loc[
-            dma_population['dma'] == 'Washington et al, DC-MD', 'dma'] = 'Washington, DC (Hagerstown, MD)'
-        dma_population.loc[dma_population['dma'] == 'Wheeling et al, WV-OH', 'dma'] = 'Wheeling, WV-Steubenville, OH'
-        dma_population.loc[dma_population['dma'] == 'Wichita Fls et al, TX-OK', 'dma'] = 'Wichita Falls, TX-Lawton, OK'
-        dma_population.loc[dma_population['dma'] == 'Wichita et al, KS', 'dma'] = 'Wichita-Hutchinson, KS Plus'
-        dma_population.loc[dma_population['dma'] == 'Wilkes Barre et al, PA', 'dma'] = 'Wilkes Barre-Scranton, PA'
-        dma_population.loc[dma_population['dma'] == 'Yakima et al, WA', 'dma'] = 'Yakima-Pasco-Richland-Kennewick, WA'
-        dma_population.loc[dma_population['dma'] == 'Yuma-El Centro, AZ-CA', 'dma'] = 'Yuma, AZ-El Centro, CA'
+        return weighted_averages(df, [data_col], weight_col, by_col)
+
+    def log_regression_summary(self, combined_for_regression, shopper_pen):
+        """ Log the full statsmodels summary of the latest month's penetration model """
+        import statsmodels.api as sm
+
+        latest = (combined_for_regression['month'] == combined_for_regression['month'].max()).to_numpy()
+        X = penetration_features(combined_for_regression)[latest]
+        logging.info(sm.OLS(shopper_pen[latest], X).fit().summary())
+
+    @instrumented_stage
+    def final_denominator(self, summary=False, bootstrap=0, confidence=0.95, bootstrap_workers=1):
+        # the frames read may be shared with other stages, derived columns go on copies
+        population = self.census.read('population', columns=self.DENOMINATOR_POPULATION_COLUMNS).copy(deep=False)
+        dma_population = self.census.read('dma_population')
+        # every month, in both modes, like the original csv read
+        numerator2 = self.read_numerator2(all_months=True)
+        dma_population = dma_population.rename(columns=dict(zip(dma_population.columns, ['dma', 'count_pop'])))
+
+        dma_population['dma'] = canonicalize_dma(dma_population['dma'])
         dma_population['rank_by_TAM'] = dma_population['count_pop'].rank(ascending=False)
         # regroup so levels aren't as defined
         population['attained_hs_or_less'] = population[
@@ -355,147 +1057,63 @@ class ProcessDMA():
                           'col_white_pct', 'col_hispanic_pct', 'col_black_pct', 'col_indian_pct', 'col_asian_pct',
                           'in_college_pct', 'hu_owner_occ_pct']
         # get weighted avg of columns we care about per dma
-        weighted_avg_df = population[
-            ['dma', 'col_hh_med_income', 'col_hh_avg_income', 'col_median_age', 'col_hu_med_rent',
-             'col_hu_med_home_value', 'attained_hs_or_less_pct',
-             'attained_associates_or_some_coll_pct', 'col_attained_bachelors_pct',
-             'col_attained_graduate_professional_pct',
-             'col_white_pct', 'col_hispanic_pct', 'col_black_pct', 'col_indian_pct', 'col_asian_pct', 'in_college_pct',
-             'hu_owner_occ_pct']]
-
-        for col in cols_to_rollup:
-            wa = self.weighted_average(df=population, data_col=col, weight_col='col_pop_2010', by_col='dma')
-            weighted_avg_df = weighted_avg_df.merge(wa, left_on='dma', right_on='dma', how='inner')
-
-        weighted_avg_df = weighted_avg_df.drop(cols_to_rollup, axis=1)
-        weighted_avg_df.drop_duplicates(inplace=True)
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Albany et al, NY', 'dma'] = 'Albany-Schenectady-Troy, NY'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Albany et al, NY', 'dma'] = 'Albany-Schenectady-Troy, NY'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Birmingham et al, AL', 'dma'] = 'Birmingham (Anniston and Tuscaloosa), AL'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Bluefield et al, WV', 'dma'] = 'Bluefield-Beckley-Oak Hill, WV'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Boston et al, MA-NH', 'dma'] = 'Boston, MA (Manchester, NH)'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Burlington et al, VT-NY', 'dma'] = 'Burlington, VT-Plattsburgh, NY'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Cedar Rapids et al, IA', 'dma'] = 'Cedar Rapids-Waterloo-Iowa City & Dubuque, IA'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Champaign et al, IL', 'dma'] = 'Champaign & Springfield-Decatur, IL'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Charleston et al, WV', 'dma'] = 'Charleston-Huntington, WV'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Cheyenne et al, WY-NE', 'dma'] = 'Cheyenne, WY-Scottsbluff, NE'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Cleveland et al, OH', 'dma'] = 'Cleveland-Akron (Canton), OH'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Colorado Sprgs et al, CO', 'dma'] = 'Colorado Springs-Pueblo, CO'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Columbia et al, MO', 'dma'] = 'Columbia-Jefferson City, MO'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Columbus et al, MS', 'dma'] = 'Columbus-Tupelo-West Point, MS'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Davenport et al, IA-IL', 'dma'] = 'Davenport, IA-Rock Island-Moline, IL'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Duluth-Superior, MN-WI', 'dma'] = 'Duluth, MN-Superior, WI'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'El Paso et al, TX-NM', 'dma'] = 'El Paso, TX'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Elmira et al, NY', 'dma'] = 'Elmira, NY'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Flint-Saginaw et al, MI', 'dma'] = 'Flint-Saginaw-Bay City, MI'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Ft. Smith et al, AR', 'dma'] = 'Ft. Smith-Fayetteville-Springdale-Rogers, AR'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Grand Junction et al, CO', 'dma'] = 'Grand Junction-Montrose, CO'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Grand Rapids et al, MI', 'dma'] = 'Grand Rapids-Kalamazoo-Battle Creek, MI'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Greensboro et al, NC', 'dma'] = 'Greensboro-High Point-Winston Salem, NC'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Greenville et al, NC', 'dma'] = 'Greenville-New Bern-Washington, NC'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Greenville et al, SC-NC', 'dma'] = f"""Greenville-Spartanburg,
-        SC-Asheville, NC-Anderson,SC""".replace("\n", "")
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Harlingen et al, TX', 'dma'] = 'Harlingen-Weslaco-Brownsville-McAllen, TX'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Harrisburg et al, PA', 'dma'] = 'Harrisburg-Lancaster-Lebanon-York, PA'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Huntsville et al, AL', 'dma'] = 'Huntsville-Decatur (Florence), AL'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Idaho Falls et al, ID', 'dma'] = 'Idaho Falls-Pocatello, ID'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Joplin-Pittsburg, MO-KS', 'dma'] = 'Joplin, MO-Pittsburg, KS'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Kansas City, MO-KS', 'dma'] = 'Kansas City, MO'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Lincoln et al, NE', 'dma'] = 'Lincoln & Hastings-Kearney, NE'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Little Rock et al, AR', 'dma'] = 'Little Rock-Pine Bluff, AR'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Medford et al, OR', 'dma'] = 'Medford-Klamath Falls, OR'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Miami-Ft. Lauderdale, FL', 'dma'] = 'Miami-Fort Lauderdale, FL'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Minot et al, ND', 'dma'] = 'Minot-Bismarck-Dickinson(Williston), ND'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Mobile et al, AL-FL', 'dma'] = 'Mobile, AL-Pensacola (Ft. Walton Beach), FL'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Monroe-El Dorado, LA-AR', 'dma'] = 'Monroe, LA-El Dorado, AR'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Myrtle Beach et al, SC', 'dma'] = 'Myrtle Beach-Florence, SC'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Norfolk et al, VA', 'dma'] = 'Norfolk-Portsmouth-Newport News, VA'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Orlando et al, FL', 'dma'] = 'Orlando-Daytona Beach-Melbourne, FL'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Ottumwa et al, IA-MO', 'dma'] = 'Ottumwa, IA-Kirksville, MO'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Paducah et al, KY-MO-IL', 'dma'] = f"""Paducah, KY-Cape
-                                                                                        Girardeau, MO-Harrisburg, IL"""
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Phoenix et al, AZ', 'dma'] = 'Phoenix, AZ'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Providence et al, RI-MA', 'dma'] = 'Providence, RI-New Bedford, MA'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Quincy et al, IL-MO-IA', 'dma'] = 'Quincy, IL-Hannibal, MO-Keokuk, IA'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Raleigh et al, NC', 'dma'] = 'Raleigh-Durham (Fayetteville), NC'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Rochester et al, MN-IA', 'dma'] = 'Rochester, MN-Mason City, IA-Austin, MN'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Sacramento et al, CA', 'dma'] = 'Sacramento-Stockton-Modesto, CA'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'San Francisco et al, CA', 'dma'] = 'San Francisco-Oakland-San Jose, CA'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Santa Barbara et al, CA', 'dma'] = f"""Santa Barbara-Santa
-                                                                                            Maria-San Luis Obispo, CA"""
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Sherman-Ada, TX-OK', 'dma'] = 'Sherman, TX-Ada, OK'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Sioux Falls et al, SD', 'dma'] = 'Sioux Falls (Mitchell), SD'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Tallahassee et al, FL-GA', 'dma'] = 'Tallahassee, FL-Thomasville, GA'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Tampa et al, FL', 'dma'] = 'Tampa-St. Petersburg (Sarasota), FL'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Traverse City et al, MI', 'dma'] = 'Traverse City-Cadillac, MI'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Tucson(Sierra Vista), AZ', 'dma'] = 'Tucson (Sierra Vista), AZ'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Tyler-Longview et al, TX', 'dma'] = 'Tyler-Longview(Lufkin & Nacogdoches), TX'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'W. Palm Beach et al, FL', 'dma'] = 'West Palm Beach-Ft. Pierce, FL'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Washington et al, DC-MD', 'dma'] = 'Washington, DC (Hagerstown, MD)'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Wheeling et al, WV-OH', 'dma'] = 'Wheeling, WV-Steubenville, OH'
-        weighted_avg_df.loc[
-            weighted_avg_df['dma'] == 'Wichita Fls et al, TX-OK', 'dma'] = 'Wichita Falls, TX-Lawton, OK'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Wichita et al, KS', 'dma'] = 'Wichita-Hutchinson, KS Plus'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Wilkes Barre et al, PA', 'dma'] = 'Wilkes Barre-Scranton, PA'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Yakima et al, WA', 'dma'] = 'Yakima-Pasco-Richland-Kennewick, WA'
-        weighted_avg_df.loc[weighted_avg_df['dma'] == 'Yuma-El Centro, AZ-CA', 'dma'] = 'Yuma, AZ-El Centro, CA'
+        weighted_avg_df = weighted_averages(population, cols_to_rollup, weight_col='col_pop_2010', by_col='dma')
+        weighted_avg_df['dma'] = canonicalize_dma(weighted_avg_df['dma'])
 
         # this isnt actually final -- need to do regression to get expected
         final_denom = dma_population.merge(weighted_avg_df, left_on='dma', right_on='dma', how='inner')
         logging.info("running regression")
-        # prepare taget variable
-        combined_for_regression = numerator2.merge(final_denom, left_on='dma', right_on='dma', how='inner')
-        combined_for_regression = combined_for_regression[combined_for_regression['cust_type'] == 'Shoppers Only']
-        max_month = combined_for_regression['month'].max()
-        combined_for_regression = combined_for_regression[combined_for_regression['month'] == max_month]
-        combined_for_regression['shopper_pen'] = combined_for_regression['count'] / combined_for_regression['count_pop']
-        combined_for_regression['wa_bachelors_and_graduate_pct'] = \
-            combined_for_regression['w_avg_col_attained_bachelors_pct'] + combined_for_regression[
-                'w_avg_col_attained_graduate_professional_pct']
-
-        combined_for_regression = combined_for_regression.drop(
-            ['dma', 'month', 'cust_type', 'count', 'count_pop', 'rank_by_TAM'], axis=1)
-        X = combined_for_regression.drop(['shopper_pen'], axis=1)
-        X = X[['w_avg_col_hh_med_income', 'w_avg_col_median_age', 'w_avg_col_hu_med_home_value',
-               'w_avg_attained_hs_or_less_pct',
-               'wa_bachelors_and_graduate_pct', 'w_avg_col_white_pct']]
-        y = combined_for_regression['shopper_pen']
-
-        model = sm.OLS(y, X).fit()
-        # add model prediction to denominator df
-        expected_penetration = model.predict(X).reset_index()
-        expected_penetration = expected_penetration.drop('index', axis=1)
-        expected_penetration.columns = ['expected_penetration']
-
-        final_denom2 = pd.concat([final_denom, expected_penetration], axis=1)
+        # prepare target variable, the shopper penetration of every dma per month
+        shoppers = numerator2.loc[numerator2['cust_type'] == 'Shoppers Only', ['month', 'dma', 'count']]
+        combined_for_regression = shoppers.merge(final_denom, left_on='dma', right_on='dma', how='inner')
+        shopper_pen = combined_for_regression['count'] / combined_for_regression['count_pop']
+
+        # fit every month at once, then predict every dma for every month
+        model = fit_by_month(penetration_features(combined_for_regression), shopper_pen,
+                             combined_for_regression['month'])
+        expected = predict_by_month(model, penetration_features(final_denom))
+        penetration_history = pd.DataFrame({
+            'month': np.repeat(model['month'].to_numpy(), len(final_denom)),
+            'dma': np.tile(final_denom['dma'].to_numpy(), len(model)),
+            'expected_penetration': expected.ravel(),
+        })
+        logging.info(f"penetration model fit for {len(model)} months")
+        if summary:
+            self.log_regression_summary(combined_for_regression, shopper_pen)
+
+        # add the latest month's model prediction to denominator df
+        final_denom2 = final_denom.copy()
+        final_denom2['expected_penetration'] = expected[-1] if len(model) else np.nan
+        if bootstrap and len(model):
+            # confidence intervals of the latest month's predictions from bootstrap resamples of its dmas
+            latest = (combined_for_regression['month'] == model['month'].iloc[-1]).to_numpy()
+            X = penetration_features(combined_for_regression)[latest]
+            lower, upper = bootstrap_intervals(X, shopper_pen[latest], penetration_features(final_denom),
+                                               resamples=bootstrap, confidence=confidence,
+                                               max_workers=bootstrap_workers)
+            final_denom2['expected_penetration_lower'] = lower
+            final_denom2['expected_penetration_upper'] = upper
+            logging.info(f"{confidence:.0%} bootstrap intervals from {bootstrap} resamples")
+        self.storage.write(model, 'penetration_model')
+        self.storage.write(penetration_history, 'penetration_history')
+
         final_denom2['last_update_datetime'] = datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")
         final_denom2['last_update_datetime'] = pd.to_datetime(final_denom2['last_update_datetime'],
                                                               format="%m/%d/%Y %H:%M:%S")
         logging.info("denominator file ready")
-        final_denom2.to_csv(os.path.join(self.data_directory, 'final_denom2.csv'), sep='|', index=False,
-                            encoding='utf-8')
+        self.storage.write(final_denom2, 'final_denom2')
+
+    def flush(self):
+        """ Wait for the session's write-behind to persist every frame written so far """
+        if self.session:
+            self.storage.flush()
+            self.census.flush()
+
+    def export_csv(self, name, path=None):
+        """ Export a stored frame as pipe delimited csv, next to the data by default """
+        if path is None:
+            path = os.path.join(self.data_directory, name + CsvStorage.extension)
+        quoting = 0 if name in CsvStorage.unquoted else 1
+        self.storage.read(name).to_csv(path, sep='|', index=False, encoding='utf-8', quoting=quoting)
+        return path
 
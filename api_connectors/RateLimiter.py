@@ -0,0 +1,201 @@
+import collections
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# responses worth retrying, the rest (bad request, unknown email, auth) fail straight away
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# responses that mean the API wants everyone to slow down
+THROTTLE_STATUS = {429, 503}
+
+
+class ApiError(Exception):
+    """ A request that failed for good, status is the HTTP status of the last try (None without a response) """
+
+    def __init__(self, message, status=None):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+
+def retry_after_seconds(value):
+    """ Seconds to wait from a Retry-After header, given in seconds or as an HTTP date """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucketLimiter(object):
+    """ Request rate limiter shared by all the workers of a client, adapting to the API's limit
+
+        Every request takes a token, tokens refill at rate per second up to
+        burst. The rate grows by increase per successful request up to
+        max_rate and is halved (at most once per cooldown seconds) when the API
+        throttles, down to min_rate. A Retry-After pauses every worker, not just
+        the one that got it.
+    """
+
+    def __init__(self, rate=50.0, max_rate=500.0, min_rate=1.0, burst=None, increase=0.1, cooldown=1.0):
+        self.rate = float(rate)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase = increase
+        self.cooldown = cooldown
+        self.tokens = self._capacity()
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_throttle = 0.0
+        self.lock = threading.Lock()
+
+    def _capacity(self):
+        return self.burst if self.burst is not None else max(1.0, self.rate)
+
+    def reserve(self):
+        """ Take a token, returns the seconds the caller has to wait before sending its request """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self._capacity(), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # tokens go negative while callers queue up, each waits for its own
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def acquire(self):
+        """ Block until a request may be sent """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after=None):
+        """ The API answered 429 / 503, slow every worker down """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_throttle >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0.0)
+                self.last_throttle = now
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+
+class RetryBudget(object):
+    """ Caps retries at ratio of the requests sent plus min_retries, over the last window seconds
+
+        Keeps a failing API from being hit with several times its normal load.
+        Only recent requests count, so a long run of successes does not build
+        up credit for a retry storm later.
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10, window=10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        # [second, first attempts, retries] of the seconds within the window
+        self.buckets = collections.deque()
+        self.lock = threading.Lock()
+
+    def _bucket(self):
+        now = time.monotonic()
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            self.buckets.popleft()
+        second = int(now)
+        if not self.buckets or self.buckets[-1][0] != second:
+            self.buckets.append([second, 0, 0])
+        return self.buckets[-1]
+
+    def deposit(self):
+        """ Record a first attempt """
+        with self.lock:
+            self._bucket()[1] += 1
+
+    def withdraw(self):
+        """ Spend one retry, False when the budget is used up """
+        with self.lock:
+            current = self._bucket()
+            attempts = sum(bucket[1] for bucket in self.buckets)
+            retries = sum(bucket[2] for bucket in self.buckets)
+            if retries + 1 > self.min_retries + self.ratio * attempts:
+                return False
+            current[2] += 1
+            return True
+
+
+class RetryPolicy(object):
+    """ When to retry a failed request: retryable errors only, within max_attempts and the retry budget
+
+        Backoff is exponential with full jitter and capped at max_delay, unless
+        the API says how long to wait with Retry-After.
+    """
+
+    def __init__(self, limiter=None, budget=None, max_attempts=5, base_delay=1.0, max_delay=30.0):
+        self.limiter = limiter if limiter is not None else TokenBucketLimiter()
+        self.budget = budget if budget is not None else RetryBudget()
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def start(self):
+        """ Seconds to wait before a first attempt """
+        self.budget.deposit()
+        return self.limiter.reserve()
+
+    def retry_delay(self, attempts, status=None, retry_after=None):
+        """ Seconds to wait before retrying after attempts failed tries, None to give up
+
+            status is the HTTP status of the last failure, None for connection
+            errors and timeouts.
+        """
+        if status is not None and status not in RETRYABLE_STATUS:
+            return None
+        if status in THROTTLE_STATUS:
+            self.limiter.on_throttle(retry_after)
+        if attempts >= self.max_attempts or not self.budget.withdraw():
+            return None
+        delay = retry_after if retry_after is not None else random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempts))
+        # the retry takes a token like any other request
+        return max(delay, self.limiter.reserve())
+
+    def get_json(self, session, url, service, **kwargs):
+        """ GET url with session (or the requests module) under the policy, returns the decoded json """
+        return self.get(session, url, service, **kwargs).json()
+
+    def get(self, session, url, service, **kwargs):
+        """ GET url with session (or the requests module) under the policy, returns the response """
+        attempts = 0
+        wait = self.start()
+        while True:
+            if wait > 0:
+                time.sleep(wait)
+            response = None
+            try:
+                response = session.get(url, **kwargs)
+                response.raise_for_status()
+            except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                status = response.status_code if response is not None else None
+                retry_after = retry_after_seconds(response.headers.get('Retry-After')) if response is not None else None
+                attempts += 1
+                wait = self.retry_delay(attempts, status, retry_after)
+                if wait is None:
+                    raise ApiError('Error message from {0}: {1}\n'
+                                   'Error details: {2}'
+                                   .format(service, e, response.text if response is not None else ''), status)
+            else:
+                self.limiter.on_success()
+                return response
@@ -1,16 +1,18 @@
 import requests
 import jwt
-import time
-import random
+
+from api_connectors.RateLimiter import RetryPolicy
 
 
 class StellaWrapper(object):
     DOMAIN = 'xxxx'
 
-    def __init__(self, api_key, secret_key, auth_email):
+    def __init__(self, api_key, secret_key, auth_email, retry_policy=None):
         self.api_key = api_key
         self.secret_key = secret_key
         self.auth_email = auth_email
+        # rate limiter and retry budget, pass the same policy to wrappers that run side by side
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=2)
 
     def _generatetoken(self):
         """ Generates a signed JSON Web Token with the Stella secret key
@@ -45,26 +47,7 @@ class StellaWrapper(object):
             data: Dictionary of data to send. In case of GET a dictionary
         """
 
-        headers = self._makeheaders()
-        max_attempts = 2
-        attempts = 0
-        while attempts < max_attempts:
-            if method == 'get':
-                response = requests.get(url, headers=headers, params=api_params)
-
-            else:
-                print('Not a get method')
-                break
-            try:
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.HTTPError as e:
-                time.sleep((2 ** attempts) + random.random())
-                attempts += 1
-
-                if attempts == max_attempts:
-                    raise Exception('Error message from Stella: {0}\n'
-                                    'Error details: {1}'
-                                    .format(e, response.text))
-            else:
-                break
+        if method != 'get':
+            print('Not a get method')
+            return None
+        return self.retry_policy.get_json(requests, url, 'Stella', headers=self._makeheaders(), params=api_params)
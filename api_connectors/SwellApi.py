@@ -1,21 +1,183 @@
 import requests
-import os
 import time
+import math
+import heapq
 import random
 import json
-from queue import Queue
+import os
+import asyncio
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from requests.adapters import HTTPAdapter
+from threading import Event
 from threading import Thread
 from threading import Lock
+from threading import Condition
 import logging
 
-global_lock = Lock()
-list_of_emails = []
-customer_details_list = []
+from api_connectors.RateLimiter import ApiError, RetryPolicy, TokenBucketLimiter, retry_after_seconds, RETRYABLE_STATUS
+from api_connectors.SwellCache import CustomerDetailsCache
+from api_connectors.SwellCheckpoint import DownloadCheckpoint
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def json_line(body):
+    """ A json response body as one line of text, passed through without decoding the json
+
+        json strings can not hold raw line breaks, so any in the body are
+        whitespace between tokens and are dropped.
+    """
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+    if '\n' in text or '\r' in text:
+        text = text.replace('\r', '').replace('\n', '')
+    text = text.strip()
+    if not text.startswith(('{', '[')):
+        raise ValueError(f"not a json response: {text[:100]}")
+    return text
+
+
+class IncompleteDownload(Exception):
+    """ Customer list pages failed after their retries, a rerun with the same checkpoint lists them again """
+
+    def __init__(self, pages):
+        super(IncompleteDownload, self).__init__(f"listing failed for {len(pages)} customer list pages: "
+                                                 f"{', '.join(f'{page}' for page in pages[:20])}")
+        self.pages = pages
+
+
+class ListSink(object):
+    """ Collects the downloaded records in a list, for callers that want them all at once """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+class JsonLinesSink(object):
+    """ Appends the downloaded records to a json lines file, gzip compressed when the path ends in .gz
+
+        Records are buffered and written buffer_size at a time, so memory stays
+        flat however many customers are downloaded. Safe to share between
+        worker threads; close (or use as a context manager) to write the rest.
+    """
+
+    def __init__(self, path, buffer_size=1000):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.records = 0
+        self.lock = Lock()
+        opener = gzip.open if path.endswith('.gz') else open
+        self.file = opener(path, 'at', encoding='utf-8')
+
+    def __call__(self, record):
+        with self.lock:
+            self.buffer.append(record)
+            self.records += 1
+            if len(self.buffer) >= self.buffer_size:
+                self._write()
+
+    def _write(self):
+        self.file.write(''.join(record + '\n' for record in self.buffer))
+        self.buffer = []
+
+    def flush(self):
+        """ Write the buffered records through to the file """
+        with self.lock:
+            self._write()
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self._write()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CustomerListing(object):
+    """ Decides which listed customers of a download need their details fetched, and delivers the details
+
+        Called with every listed page, returns the emails to fetch. An email
+        listed on several pages is fetched once. With a cache, customers whose
+        list entry has not changed since their details were cached are passed to
+        sink straight from the cache. Progress is recorded on checkpoint, and
+        pages that can not be listed are passed to dead_letter.
+    """
+
+    def __init__(self, sink, checkpoint=None, cache=None, dead_letter=None):
+        self.sink = sink
+        self.checkpoint = checkpoint
+        self.cache = cache
+        self.dead_letter = dead_letter
+        # a resumed download already has the emails of the pages listed before
+        self.seen = set(checkpoint.listed_emails()) if checkpoint is not None else set()
+        self.from_cache = 0
+        # pages that could not be listed, which fail the download
+        self.failed_pages = []
+        self.lock = Lock()
+
+    def __call__(self, page, customers):
+        with self.lock:
+            new_customers = {}
+            for customer in customers:
+                if customer['email'] not in self.seen:
+                    new_customers[customer['email']] = customer
+            self.seen.update(new_customers)
+        if self.checkpoint is not None:
+            self.checkpoint.page_done(page, list(new_customers))
+        if self.cache is None:
+            return list(new_customers)
+
+        cached = self.cache.unchanged(new_customers.values())
+        for email, record in cached.items():
+            self.sink(record)
+            if self.checkpoint is not None:
+                self.checkpoint.email_done(email)
+        with self.lock:
+            self.from_cache += len(cached)
+        return [email for email in new_customers if email not in cached]
+
+    def page_failed(self, page, error):
+        """ A page could not be listed, its customers are missing from the download """
+        with self.lock:
+            self.failed_pages.append(page)
+        if self.checkpoint is not None:
+            self.checkpoint.page_failed(page, error)
+        if self.dead_letter is not None:
+            self.dead_letter(json.dumps({'page': page, 'error': f'{error}', 'status': getattr(error, 'status', None),
+                                         'failed_at': time.time()}))
+
+    def deliver(self, email, record):
+        """ Pass the details fetched for email to the sink """
+        self.sink(record)
+        if self.cache is not None:
+            self.cache.store(email, record)
+        if self.checkpoint is not None:
+            self.checkpoint.email_done(email)
+
+
+def wait_queue(queue, stop=None):
+    """ queue.join, giving up once stop is set """
+    with queue.all_tasks_done:
+        while queue.unfinished_tasks and not (stop is not None and stop.is_set()):
+            queue.all_tasks_done.wait(0.5)
 
 
 class SwellDownloadWorker(Thread):
 
-    def __init__(self, in_queue, out_queue, guid, api_key, name, date):
+    def __init__(self, in_queue, out_queue, guid, api_key, name, date, swellapi=None, listing=None, stop=None):
         super(SwellDownloadWorker, self).__init__()
         self.in_queue = in_queue
         self.out_queue = out_queue
@@ -23,79 +185,337 @@ class SwellDownloadWorker(Thread):
         self.api_key = api_key
         self.name = name
         self.date = date
-        self.swellapi = SwellWrapper(self.guid, self.api_key)
+        self.swellapi = swellapi or SwellWrapper(self.guid, self.api_key)
+        # a CustomerListing, filtering the emails of every page
+        self.listing = listing
+        # set when the download fails or is cancelled, the worker leaves the remaining pages
+        self.stop = stop if stop is not None else Event()
+        # the sink error that failed the download
+        self.error = None
 
     def run(self):
         while True:
             each_page = self.in_queue.get()
-            self._get_customer_list(each_page)
-            self.in_queue.task_done()
+            try:
+                if each_page is None:
+                    # the download is over
+                    return
+                if not self.stop.is_set():
+                    self._get_customer_list(each_page)
+            finally:
+                self.in_queue.task_done()
 
     def _get_customer_list(self, each_page):
         try:
             response = self.swellapi._get_last_updated_customers(self.date, each_page)
-            for each_dict in response['customers']:
-                self.out_queue.put(each_dict['email'])
-                list_of_emails.append(each_dict['email'])
         except Exception as e:
             logging.info(f"Error while getting customer list in thread.. {self.name}, {e}")
+            if self.listing is not None:
+                try:
+                    self.listing.page_failed(each_page, e)
+                except Exception as error:
+                    self.error = error
+                    self.stop.set()
+            return
+        try:
+            if self.listing is not None:
+                emails = self.listing(each_page, response['customers'])
+            else:
+                emails = [each_dict['email'] for each_dict in response['customers']]
+        except Exception as e:
+            # cached customers go to the sink here, a sink that fails fails the download
+            logging.info(f"Error while listing customers in thread.. {self.name}, {e}")
+            self.error = e
+            self.stop.set()
+            return
+        for email in emails:
+            while not self.stop.is_set():
+                try:
+                    self.out_queue.put(email, timeout=1)
+                    break
+                except Full:
+                    continue
+
+
+def details_retry_delay(attempts, error, budget=None, max_retries=3, base_delay=1.0, max_delay=60.0):
+    """ Seconds until a customer's details are asked again after attempts failures, None to give up
+
+        Only failures that may pass (connection errors, timeouts, 408, 429 and
+        5xx) are retried, max_retries times (so up to max_retries + 1 attempts)
+        and within budget, a RetryBudget.
+        The backoff is exponential with full jitter, capped at max_delay.
+    """
+    status = getattr(error, 'status', None)
+    if attempts > max_retries or (status is not None and status not in RETRYABLE_STATUS):
+        return None
+    if budget is not None and not budget.withdraw():
+        return None
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempts))
+
+
+def dead_letter_record(email, error, attempts):
+    """ The dead letter of a customer whose details could not be downloaded, as a json string """
+    return json.dumps({'email': email, 'error': f'{error}', 'status': getattr(error, 'status', None),
+                       'attempts': attempts, 'failed_at': time.time()})
+
+
+class DetailsRetryScheduler(Thread):
+    """ Puts emails whose details failed back on the details queue after a per-email backoff
+
+        Failed emails wait in a delay queue while the workers carry on with the
+        rest, so retries overlap the main pass instead of trailing it. Retries
+        are spent from budget, a RetryBudget, and delayed by
+        details_retry_delay. Emails still failing after max_retries retries,
+        failing for good (4xx besides 408 / 429, like an unknown customer) or
+        out of budget are passed to dead_letter as a dead_letter_record.
+    """
+
+    def __init__(self, queue, dead_letter=None, max_retries=3, base_delay=1.0, max_delay=60.0, budget=None):
+        super(DetailsRetryScheduler, self).__init__(daemon=True)
+        self.queue = queue
+        self.dead_letter = dead_letter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.attempts = {}
+        self.dead_letters = 0
+        # (due time, sequence, email)
+        self.delayed = []
+        self.sequence = 0
+        self.condition = Condition()
+        self.stopped = False
+
+    def next_retry(self, email, error):
+        """ Seconds until email is retried after error, None when it went to the dead letters """
+        with self.condition:
+            attempts = self.attempts.get(email, 0) + 1
+            delay = details_retry_delay(attempts, error, self.budget, self.max_retries, self.base_delay,
+                                        self.max_delay)
+            if delay is not None:
+                self.attempts[email] = attempts
+                return delay
+            self.attempts.pop(email, None)
+            self.dead_letters += 1
+        logging.info(f"giving up on customer details of {email} after {attempts} attempts: {error}")
+        if self.dead_letter is not None:
+            self.dead_letter(dead_letter_record(email, error, attempts))
+        return None
+
+    def failed(self, email, error):
+        """ Schedule a retry of email, call before marking its queue item done """
+        delay = self.next_retry(email, error)
+        if delay is None:
+            return
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.delayed, (time.monotonic() + delay, self.sequence, email))
+            self.condition.notify_all()
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    due, sequence, email = self.delayed[0]
+                    try:
+                        # never block while holding the lock the workers need to schedule retries
+                        self.queue.put_nowait(email)
+                    except Full:
+                        break
+                    heapq.heappop(self.delayed)
+                    self.condition.notify_all()
+                if not self.delayed:
+                    timeout = None
+                elif self.delayed[0][0] <= now:
+                    timeout = 0.05
+                else:
+                    timeout = self.delayed[0][0] - now
+                self.condition.wait(timeout)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.join()
+
+    def join_queue(self, stop=None):
+        """ Wait until every email in the queue is done and no retry is waiting, or until stop is set """
+        while not (stop is not None and stop.is_set()):
+            wait_queue(self.queue, stop)
+            with self.condition:
+                # workers schedule their retry before marking the item done
+                if not self.queue.unfinished_tasks and not self.delayed:
+                    return
+                self.condition.wait(0.5)
 
 
 class SwellCustomerDetailsWorker(Thread):
-    def __init__(self, out_queue, rejectedemail_queue, guid, api_key, name):
+    def __init__(self, out_queue, retries, guid, api_key, name, swellapi=None, sink=None,
+                 listing=None, autoscaler=None, stop=None):
         super(SwellCustomerDetailsWorker, self).__init__()
         self.out_queue = out_queue
-        self.rejectedemail_queue = rejectedemail_queue
+        # a DetailsRetryScheduler for the emails that fail
+        self.retries = retries
         self.guid = guid
         self.api_key = api_key
         self.name = name
-        self.swellapi = SwellWrapper(self.guid, self.api_key)
+        self.swellapi = swellapi or SwellWrapper(self.guid, self.api_key)
+        # called with every customer's details as a json string
+        self.sink = sink if sink is not None else ListSink()
+        # a CustomerListing delivering the details instead of sink
+        self.listing = listing
+        # a DetailsWorkerAutoscaler told the latency of every request
+        self.autoscaler = autoscaler
+        # set to retire the worker once it finishes its current email
+        self.stopped = Event()
+        # set when the download fails or is cancelled, shared by all the workers
+        self.stop = stop if stop is not None else Event()
+        # the sink error that failed the download
+        self.error = None
         self.processed_records = 0
+        self.rejected_records = 0
 
     def run(self):
-        while True:
-            email = self.out_queue.get()
-            self._get_customer_details(email)
-            self.out_queue.task_done()
+        while not self.stopped.is_set() and not self.stop.is_set():
+            try:
+                email = self.out_queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                if not self.stop.is_set():
+                    self._get_customer_details(email)
+            finally:
+                self.out_queue.task_done()
 
     def _get_customer_details(self, email):
+        ts = time.perf_counter()
+        failed = False
         try:
-            response = self.swellapi._get_customer_details_json(email)
+            record = self.swellapi._get_customer_details_record(email)
         except Exception as e:
             logging.info(f"Error while getting customer details in thread.. {self.name}, {e}")
-            self.rejectedemail_queue.put(email)
+            self.rejected_records += 1
+            try:
+                self.retries.failed(email, e)
+            except Exception as error:
+                # like a failing sink, a lost dead letter fails the download
+                logging.info(f"Error while writing a dead letter in thread.. {self.name}, {error}")
+                self.error = error
+                self.stop.set()
+            # an unknown customer is no sign of an overloaded API
+            failed = getattr(e, 'status', None) is None or e.status in RETRYABLE_STATUS
         else:
-            customer_details_list.append(json.dumps(response))
+            try:
+                if self.listing is not None:
+                    self.listing.deliver(email, record)
+                else:
+                    self.sink(record)
+            except Exception as e:
+                # the sink is broken rather than the customer, fail the download instead of losing records
+                logging.info(f"Error while delivering customer details in thread.. {self.name}, {e}")
+                self.rejected_records += 1
+                self.error = e
+                self.stop.set()
         finally:
             self.processed_records += 1
+            if self.autoscaler is not None:
+                self.autoscaler.record(time.perf_counter() - ts, failed)
             # print(f'Swell data download thread {self.name} and processed records : {self.processed_records}')
 
 
-class SwellRejectedEmailsWorker(Thread):
-    def __init__(self, rejectedemail_queue, guid, api_key, name):
-        super(SwellRejectedEmailsWorker, self).__init__()
-        self.rejectedemail_queue = rejectedemail_queue
-        self.guid = guid
-        self.api_key = api_key
-        self.name = name
-        self.swellapi = SwellWrapper(self.guid, self.api_key)
-        self.processed_records = 0
+class DetailsWorkerAutoscaler(Thread):
+    """ Resizes the pool of customer details workers to the latency and error rate the API shows
 
-    def run(self):
-        while True:
-            email = self.rejectedemail_queue.get()
-            self._get_customer_details(email)
-            self.rejectedemail_queue.task_done()
+        Every interval the pool is scaled by the latency gradient, tolerance
+        times the lowest latency seen over the latest one (between 0.5 and 1),
+        like a gradient concurrency limiter. While emails are waiting in queue
+        and latency is within tolerance the pool grows by the square root of its
+        size, and goes back when that did not raise the throughput (when the
+        rate limiter is what holds the download back), trying again after hold
+        intervals. An error rate above max_error_rate shrinks the pool by a
+        quarter. start_worker starts a worker and returns it; the pool stays
+        between min_workers and max_workers.
+    """
 
-    def _get_customer_details(self, email):
-        try:
-            response = self.swellapi._get_customer_details_json(email)
-        except Exception as e:
-            logging.info(f"Error while getting rejected emails in thread.. {self.name}, {e}")
+    def __init__(self, start_worker, queue, min_workers, max_workers, interval=2.0, tolerance=2.0,
+                 max_error_rate=0.05, hold=5):
+        super(DetailsWorkerAutoscaler, self).__init__(daemon=True)
+        self.start_worker = start_worker
+        self.queue = queue
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.tolerance = tolerance
+        self.max_error_rate = max_error_rate
+        self.hold = hold
+        self.workers = []
+        self.min_latency = None
+        # pool size and throughput before the last growth, to tell whether it paid off
+        self.grown_from = None
+        self.holding = 0
+        self.measured = time.monotonic()
+        self.completed = 0
+        self.failures = 0
+        self.latency = 0.0
+        self.lock = Lock()
+        self.stopped = Event()
+
+    def record(self, latency, failed):
+        with self.lock:
+            self.completed += 1
+            self.failures += failed
+            self.latency += latency
+
+    def scale_to(self, size):
+        with self.lock:
+            active = [worker for worker in self.workers if worker.is_alive() and not worker.stopped.is_set()]
+            for worker in range(len(active), size):
+                self.workers.append(self.start_worker())
+            for worker in active[size:]:
+                worker.stopped.set()
+
+    def resize(self):
+        with self.lock:
+            completed, failures, latency = self.completed, self.failures, self.latency
+            self.completed, self.failures, self.latency = 0, 0, 0.0
+            size = sum(worker.is_alive() and not worker.stopped.is_set() for worker in self.workers)
+        now = time.monotonic()
+        throughput = completed / (now - self.measured)
+        self.measured = now
+        if not completed:
+            return
+        latency /= completed
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        grown_from, self.grown_from = self.grown_from, None
+        self.holding = max(0, self.holding - 1)
+        gradient = max(0.5, min(1.0, self.tolerance * self.min_latency / latency))
+        if failures / completed > self.max_error_rate:
+            target = size * 0.75
+        elif gradient < 1.0 or not self.queue.qsize():
+            target = size * gradient
+        elif grown_from is not None and throughput < grown_from[1] * 1.05:
+            target = grown_from[0]
+            self.holding = self.hold
+        elif self.holding:
+            target = size
         else:
-            customer_details_list.append(json.dumps(response))
-        finally:
-            self.processed_records += 1
+            target = size + math.sqrt(size)
+            self.grown_from = (size, throughput)
+        target = max(self.min_workers, min(self.max_workers, int(round(target))))
+        if target != size:
+            logging.info(f"details workers {size} -> {target}, {throughput:.0f} per second, latency "
+                         f"{latency * 1000:.0f}ms (lowest {self.min_latency * 1000:.0f}ms), "
+                         f"failures {failures} of {completed}")
+            self.scale_to(target)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.resize()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
 
 
 class SwellWrapper(object):
@@ -103,10 +523,44 @@ class SwellWrapper(object):
     # endpoints
     ALL_CUSTOMERS = "v2/customers/all/"
     CUSTOMER_DETAILS = "v2/customers/"
+    # threads of the threaded download, the details workers are autoscaled between the limits
+    LIST_WORKERS = 5
+    DETAILS_WORKERS = 20
+    MIN_DETAILS_WORKERS = 5
+    MAX_DETAILS_WORKERS = 100
+    # listed emails waiting for a details worker, listing pauses while the queue is full
+    DETAILS_QUEUE_SIZE = 1000
+    # retries of a customer's details, by the retry scheduler, its requests are not retried on their own
+    DETAILS_RETRIES = 5
+    # json lines file the customers failing for good go to, unless download is given a dead_letter
+    DEAD_LETTERS = 'swell_dead_letters_{date}.jsonl'
+    # requests per second to start at and to grow up to while the API keeps up
+    RATE_LIMIT = 50
+    MAX_RATE_LIMIT = 500
 
-    def __init__(self, guid, api_key):
+    def __init__(self, guid, api_key, session=None, retry_policy=None):
         self.guid = guid
         self.api_key = api_key
+        # one rate limiter and retry budget for all the workers sharing this wrapper
+        self.retry_policy = retry_policy or RetryPolicy(
+            TokenBucketLimiter(rate=self.RATE_LIMIT, max_rate=self.MAX_RATE_LIMIT), max_attempts=5)
+        # a single attempt for the details of the download, retried with a backoff of their own by the download
+        self.details_policy = RetryPolicy(self.retry_policy.limiter, self.retry_policy.budget, max_attempts=1)
+        self.all_customers_url = self.BASEURL + self.ALL_CUSTOMERS
+        self.customer_details_url = self.BASEURL + self.CUSTOMER_DETAILS
+        # one keep-alive session shared by all the download workers, so connections are reused
+        self.session = session or self._make_session(
+            self.LIST_WORKERS + self.MAX_DETAILS_WORKERS)
+
+    def _make_session(self, pool_size):
+        """ requests session with the auth headers and a connection pool for pool_size threads """
+        session = requests.Session()
+        session.headers.update(self._makeheaders())
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
     def _makeheaders(self):
         """ Generate headers for the APIget request """
@@ -116,7 +570,7 @@ class SwellWrapper(object):
             'x-api-key': f'{self.api_key}'
         }
 
-    def make_api_call(self, url, method='get', api_params=None):
+    def make_api_call(self, url, method='get', api_params=None, raw=False, retry_policy=None):
         """ Sends secure request to the Stella API
 
             Arguments:
@@ -126,33 +580,14 @@ class SwellWrapper(object):
             Kwargs:
             method: HTTP method to send (default GET)
             data: Dictionary of data to send. In case of GET a dictionary
+            raw: return the body as a line of json text instead of decoding it
+            retry_policy: RetryPolicy to send it under instead of the wrapper's
         """
-        headers = self._makeheaders()
-        max_attempts = 10
-        attempts = 0
-        while attempts < max_attempts:
-            if method == 'get':
-                response = requests.get(url, headers=headers, params=api_params)
-
-            else:
-                print('Not a get method')
-                break
-            try:
-                response.raise_for_status()
-                return response.json()
-            except Exception as e:
-                logging.info(f"sleeping for {(2 ** attempts) + random.random()}")
-                time.sleep((2 ** attempts) + random.random())
-                attempts += 1
-
-                if attempts == max_attempts:
-                    raise Exception('Error message from Swell: {0}\n'
-                                    'Error details: {1}'
-                                    .format(e, response.text))
-            else:
-                break
-            finally:
-                pass
+        if method != 'get':
+            print('Not a get method')
+            return None
+        response = (retry_policy or self.retry_policy).get(self.session, url, 'Swell', params=api_params)
+        return json_line(response.content) if raw else response.json()
 
     def _generate_all_customer_params(self, date, page_number):
         return {"last_seen_at": f'{date}', "page": page_number}
@@ -161,53 +596,450 @@ class SwellWrapper(object):
         return {"customer_email": f'{email}'}
 
     def _get_last_updated_customers(self, date, page):
-        url = os.path.join(self.BASEURL, self.ALL_CUSTOMERS)
-        return self.make_api_call(url, 'get', self._generate_all_customer_params(date, page))
+        return self.make_api_call(self.all_customers_url, 'get', self._generate_all_customer_params(date, page))
 
     def _get_total_number_of_pages(self, date, records_per_page):
-        url = os.path.join(self.BASEURL, self.ALL_CUSTOMERS)
-        responses = self.make_api_call(url, 'get', {"last_seen_at": f'{date}', "per_page": f'{records_per_page}'})
+        responses = self.make_api_call(self.all_customers_url, 'get',
+                                       {"last_seen_at": f'{date}', "per_page": f'{records_per_page}'})
         return responses['links']['total_pages']
 
     def _get_customer_details_json(self, email):
-        url = os.path.join(self.BASEURL, self.CUSTOMER_DETAILS)
-        return self.make_api_call(url, 'get', self._generate_customer_detail_params(email))
+        return self.make_api_call(self.customer_details_url, 'get', self._generate_customer_detail_params(email))
+
+    def _get_customer_details_record(self, email):
+        # the details are only passed on, decoding and encoding them again would cost more than the request
+        return self.make_api_call(self.customer_details_url, 'get', self._generate_customer_detail_params(email),
+                                  raw=True, retry_policy=self.details_policy)
+
+    async def _make_api_call_async(self, session, url, api_params=None, raw=False, retry_policy=None):
+        """ make_api_call on an aiohttp session, waiting for the limiter without blocking the other requests """
+        retry_policy = retry_policy or self.retry_policy
+        attempts = 0
+        wait = retry_policy.start()
+        while True:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            body = b''
+            try:
+                async with session.get(url, params=api_params) as response:
+                    body = await response.read()
+                    response.raise_for_status()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                headers = getattr(e, 'headers', None) or {}
+                status = getattr(e, 'status', None)
+                attempts += 1
+                wait = retry_policy.retry_delay(attempts, status, retry_after_seconds(headers.get('Retry-After')))
+                if wait is None:
+                    raise ApiError('Error message from Swell: {0}\n'
+                                   'Error details: {1}'
+                                   .format(e, body.decode('utf-8', 'replace')), status)
+            else:
+                retry_policy.limiter.on_success()
+                return json_line(body) if raw else json.loads(body)
+
+    def _remaining_work(self, checkpoint, total_pages):
+        """ Pages still to list and emails listed but not downloaded yet """
+        if checkpoint is None:
+            return list(range(1, total_pages + 1)), []
+        completed_pages = checkpoint.completed_pages()
+        pending_emails = checkpoint.pending_emails()
+        if completed_pages:
+            logging.info(f"resuming from checkpoint: {len(completed_pages)} of {total_pages} pages listed, "
+                         f"{len(checkpoint.failed_pages())} failed before, {len(pending_emails)} listed customers left")
+        return [page for page in range(1, total_pages + 1) if page not in completed_pages], pending_emails
+
+    async def download_async(self, date, sink, concurrency=200, list_concurrency=5, checkpoint=None, cache=None,
+                             dead_letter=None, stop=None):
+        """ download on a single thread, with up to concurrency customer detail requests in flight
+
+            Pages are listed by list_concurrency coroutines feeding a bounded
+            email queue that concurrency detail coroutines drain. Emails whose
+            details fail are put back on the queue after a backoff, like the
+            threaded download, and passed to dead_letter when they keep failing,
+            the DEAD_LETTERS file by default.
+            sink is called with the details of every customer as a json string;
+            returns the number of customers. Progress is recorded on checkpoint,
+            a DownloadCheckpoint, and unchanged customers are taken from cache,
+            a CustomerDetailsCache.
+
+            The sink, checkpoint, cache and dead_letter are called on a thread of
+            their own, one call at a time, so their file writes do not hold up
+            the requests in flight. Await this from code already running an event
+            loop, like a Jupyter notebook, where download(mode='async') can not
+            start one. Setting stop, a threading Event, cancels the download.
+        """
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the async download')
+        ts = time.time()
+        list_url = self.all_customers_url
+        details_url = self.customer_details_url
+        processed_records = 0
+        # failures of the emails waiting for a retry
+        attempts = {}
+        dead_letters = 0
+        delayed = set()
+        # sink errors, which fail the download
+        errors = []
+        failed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        # the blocking sqlite and file writes, kept off the event loop
+        io = ThreadPoolExecutor(max_workers=1)
+
+        def blocking(function, *args):
+            return loop.run_in_executor(io, function, *args)
+
+        connector = aiohttp.TCPConnector(limit=concurrency + list_concurrency)
+        async with aiohttp.ClientSession(headers=self._makeheaders(), connector=connector) as session:
+            total_pages = await blocking(lambda: checkpoint.total_pages) if checkpoint is not None else None
+            if total_pages is None:
+                response = await self._make_api_call_async(session, list_url,
+                                                           {"last_seen_at": f'{date}', "per_page": '100'})
+                total_pages = response['links']['total_pages']
+                if checkpoint is not None:
+                    await blocking(checkpoint.set_total_pages, total_pages)
+            logging.info(f"total number of pages: {total_pages}")
+            remaining_pages, pending_emails = await blocking(self._remaining_work, checkpoint, total_pages)
+
+            pages = asyncio.Queue()
+            emails = asyncio.Queue(maxsize=concurrency * 10)
+
+            async def retry_later(email, delay):
+                await asyncio.sleep(delay)
+                await emails.put(email)
+
+            async def list_worker(name):
+                while True:
+                    page = await pages.get()
+                    try:
+                        response = await self._make_api_call_async(
+                            session, list_url, self._generate_all_customer_params(date, page))
+                    except Exception as e:
+                        logging.info(f"Error while getting customer list in task.. {name}, {e}")
+                        try:
+                            await blocking(listing.page_failed, page, e)
+                        except Exception as error:
+                            errors.append(error)
+                            failed.set()
+                        pages.task_done()
+                        continue
+                    try:
+                        for email in await blocking(listing, page, response['customers']):
+                            await emails.put(email)
+                    except Exception as e:
+                        logging.info(f"Error while listing customers in task.. {name}, {e}")
+                        errors.append(e)
+                        failed.set()
+                    finally:
+                        pages.task_done()
+
+            async def details_worker(name):
+                while True:
+                    email = await emails.get()
+                    try:
+                        record = await self._make_api_call_async(
+                            session, details_url, self._generate_customer_detail_params(email), raw=True,
+                            retry_policy=self.details_policy)
+                    except Exception as e:
+                        logging.info(f"Error while getting customer details in task.. {name}, {e}")
+                        tries = attempts.pop(email, 0) + 1
+                        delay = details_retry_delay(tries, e, self.retry_policy.budget, self.DETAILS_RETRIES)
+                        if delay is None:
+                            nonlocal dead_letters
+                            dead_letters += 1
+                            logging.info(f"giving up on customer details of {email} after {tries} attempts: {e}")
+                            try:
+                                await blocking(dead_letter, dead_letter_record(email, e, tries))
+                            except Exception as error:
+                                # like a failing sink, a lost dead letter fails the download
+                                logging.info(f"Error while writing a dead letter in task.. {name}, {error}")
+                                errors.append(error)
+                                failed.set()
+                        else:
+                            attempts[email] = tries
+                            retry = asyncio.ensure_future(retry_later(email, delay))
+                            delayed.add(retry)
+                            retry.add_done_callback(delayed.discard)
+                    else:
+                        try:
+                            await blocking(listing.deliver, email, record)
+                        except Exception as e:
+                            # the sink is broken rather than the customer, fail the download instead of losing records
+                            logging.info(f"Error while delivering customer details in task.. {name}, {e}")
+                            errors.append(e)
+                            failed.set()
+                        else:
+                            nonlocal processed_records
+                            processed_records += 1
+                    finally:
+                        emails.task_done()
+
+            async def finish():
+                for each_page in remaining_pages:
+                    pages.put_nowait(each_page)
+                for email in pending_emails:
+                    await emails.put(email)
+                await pages.join()
+                while True:
+                    await emails.join()
+                    if not delayed:
+                        break
+                    # a retry puts its email back on the queue before it finishes
+                    await asyncio.wait(set(delayed))
+
+            dead_letter, opened = self._dead_letter_sink(dead_letter, date)
+            listing = CustomerListing(sink, checkpoint, cache, dead_letter)
+            workers = [asyncio.ensure_future(list_worker(name)) for name in range(list_concurrency)]
+            workers += [asyncio.ensure_future(details_worker(name)) for name in range(concurrency)]
+            finishing = asyncio.ensure_future(finish())
+
+            async def cancelled():
+                while stop is None or not stop.is_set():
+                    await asyncio.sleep(0.5)
+
+            failing = asyncio.ensure_future(failed.wait())
+            cancelling = asyncio.ensure_future(cancelled())
+            workers += [finishing, failing, cancelling]
+            try:
+                await asyncio.wait([finishing, failing, cancelling], return_when=asyncio.FIRST_COMPLETED)
+                if errors:
+                    raise errors[0]
+                if not cancelling.done():
+                    finishing.result()
+            finally:
+                workers += delayed
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                io.shutdown()
+                if opened is not None:
+                    self._close_dead_letters(opened)
+
+        if listing.failed_pages and not (stop is not None and stop.is_set()):
+            raise IncompleteDownload(sorted(listing.failed_pages))
+        processed_records += listing.from_cache
+        logging.info(f"time took to process the records: {time.time() - ts}")
+        logging.info(f"Total processed records : {processed_records}, failed for good : {dead_letters}")
+        return processed_records
+
+    def _dead_letter_sink(self, dead_letter, date):
+        """ dead_letter as a callable, and the JsonLinesSink opened for a path, DEAD_LETTERS by default """
+        if dead_letter is None:
+            dead_letter = self.DEAD_LETTERS.format(date=date)
+        if isinstance(dead_letter, str):
+            opened = JsonLinesSink(dead_letter, buffer_size=1)
+            return opened, opened
+        return dead_letter, None
+
+    @staticmethod
+    def _close_dead_letters(dead_letters):
+        """ Close a dead letters file, removing it again when it stayed empty """
+        dead_letters.close()
+        if dead_letters.records:
+            logging.info(f"{dead_letters.records} customers or pages failed for good, see {dead_letters.path}")
+        elif not os.path.getsize(dead_letters.path):
+            os.remove(dead_letters.path)
+
+    def download(self, date, mode='threads', concurrency=200, sink=None, checkpoint=None, cache=None,
+                 dead_letter=None, stop=None):
+        """ Download the details of the customers seen since date, as json strings
+
+            Every customer's details are passed to sink as they arrive, like a
+            JsonLinesSink or any callable, and the number of customers is
+            returned. Without a sink they are collected and returned as a list.
+            mode 'async' runs download_async with up to concurrency detail
+            requests in flight on one thread, 'threads' uses the worker threads,
+            as many details workers as the API's latency and error rate allow.
+            The async mode starts an event loop, so it can not be used where one
+            is already running (a Jupyter notebook); await download_async there.
+
+            With a checkpoint (a DownloadCheckpoint or the path of its sqlite
+            file) an interrupted download resumes where it stopped when run
+            again for the same date, delivering only the remaining customers to
+            sink. Use a sink that keeps what earlier runs wrote, like a
+            JsonLinesSink on the same file; a few records may be repeated.
+
+            With a cache (a CustomerDetailsCache or the path of its sqlite
+            file) the details of customers whose entry in the customer list has
+            not changed since the last download are taken from the cache, so
+            only new and changed customers are fetched. Every customer is still
+            passed to sink.
+
+            Failed customers are retried after a backoff while the download goes
+            on. The ones still failing after DETAILS_RETRIES retries, or failing
+            for good, are passed with the pages of the customer list that could
+            not be listed to dead_letter (a callable or the path of a json lines file), by
+            default the DEAD_LETTERS file of the date in the working directory,
+            which is removed again when no customer failed. When a page of the
+            customer list keeps failing the download raises IncompleteDownload
+            once the other customers are done; the checkpoint is kept, so a
+            rerun lists the failed pages again.
+
+            Setting stop, a threading Event, cancels the download: the workers
+            leave the remaining pages and customers, and a checkpoint keeps the
+            progress made so far.
+        """
+        if sink is None:
+            collected = ListSink()
+            self.download(date, mode=mode, concurrency=concurrency, sink=collected, checkpoint=checkpoint,
+                          cache=cache, dead_letter=dead_letter, stop=stop)
+            return collected.records
+
+        opened = []
+        if checkpoint is not None:
+            if not isinstance(checkpoint, DownloadCheckpoint):
+                checkpoint = DownloadCheckpoint(checkpoint, date)
+                opened.append(checkpoint)
+            elif checkpoint.date != f'{date}':
+                raise ValueError(f"checkpoint of {checkpoint.date} can not resume the download of {date}")
+            checkpoint.before_commit = getattr(sink, 'flush', None)
+        if cache is not None and not isinstance(cache, CustomerDetailsCache):
+            cache = CustomerDetailsCache(cache)
+            opened.append(cache)
+        dead_letter, dead_letters = self._dead_letter_sink(dead_letter, date)
+        stop = stop if stop is not None else Event()
+        try:
+            processed_records = self._download(date, mode, concurrency, sink, checkpoint, cache, dead_letter, stop)
+            if checkpoint is not None and not stop.is_set():
+                checkpoint.finish()
+            return processed_records
+        finally:
+            # on an interrupt, keep the progress made so far
+            if cache is not None:
+                cache.flush()
+            if checkpoint is not None:
+                checkpoint.flush()
+            for store in opened:
+                store.close()
+            if dead_letters is not None:
+                self._close_dead_letters(dead_letters)
+
+    def _download(self, date, mode, concurrency, sink, checkpoint, cache, dead_letter, stop):
+        if mode == 'async':
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+            else:
+                raise RuntimeError("download(mode='async') can not run inside a running event loop, "
+                                   "await download_async instead")
+            return asyncio.run(self.download_async(date, sink, concurrency=concurrency, checkpoint=checkpoint,
+                                                   cache=cache, dead_letter=dead_letter, stop=stop))
 
-    def download(self, date):
         ts = time.time()
         # get the total number of
-        total_pages = self._get_total_number_of_pages(date, 100)
+        total_pages = checkpoint.total_pages if checkpoint is not None else None
+        if total_pages is None:
+            total_pages = self._get_total_number_of_pages(date, 100)
+            if checkpoint is not None:
+                checkpoint.set_total_pages(total_pages)
+        remaining_pages, pending_emails = self._remaining_work(checkpoint, total_pages)
+        listing = CustomerListing(sink, checkpoint, cache, dead_letter)
         in_queue = Queue()
-        out_queue = Queue()
-        rejectedemail_queue = Queue()
+        out_queue = Queue(maxsize=self.DETAILS_QUEUE_SIZE)
+        retries = DetailsRetryScheduler(out_queue, dead_letter, max_retries=self.DETAILS_RETRIES,
+                                        budget=self.retry_policy.budget)
+        retries.start()
 
-        for list_thread in range(5):
-            worker1 = SwellDownloadWorker(in_queue, out_queue, self.guid, self.api_key, list_thread, date)
+        # stop is set by the caller to cancel, and by a worker whose sink fails
+        list_workers = []
+        for list_thread in range(self.LIST_WORKERS):
+            worker1 = SwellDownloadWorker(in_queue, out_queue, self.guid, self.api_key, list_thread, date,
+                                          swellapi=self, listing=listing, stop=stop)
             worker1.setDaemon(True)
             worker1.start()
+            list_workers.append(worker1)
 
-        for details_thread in range(20):
-            worker2 = SwellCustomerDetailsWorker(out_queue, rejectedemail_queue,
-                                                 self.guid, self.api_key, details_thread)
+        def start_details_worker():
+            worker2 = SwellCustomerDetailsWorker(out_queue, retries, self.guid, self.api_key,
+                                                 len(autoscaler.workers), swellapi=self, listing=listing,
+                                                 autoscaler=autoscaler, stop=stop)
             worker2.setDaemon(True)
             worker2.start()
+            return worker2
+
+        autoscaler = DetailsWorkerAutoscaler(start_details_worker, out_queue, self.MIN_DETAILS_WORKERS,
+                                             self.MAX_DETAILS_WORKERS)
+        autoscaler.scale_to(self.DETAILS_WORKERS)
+        autoscaler.start()
 
         logging.info(f"total number of pages: {total_pages}")
-        for each_page in range(1, total_pages + 1):
-            in_queue.put(each_page)
+        try:
+            for email in pending_emails:
+                while not stop.is_set():
+                    try:
+                        out_queue.put(email, timeout=1)
+                        break
+                    except Full:
+                        continue
+            for each_page in remaining_pages:
+                in_queue.put(each_page)
 
-        in_queue.join()
-        out_queue.join()
+            wait_queue(in_queue, stop)
+            retries.join_queue(stop)
+        except BaseException:
+            # an interrupt, let the list workers leave the queue they wait on
+            stop.set()
+            raise
+        finally:
+            for worker in list_workers:
+                in_queue.put(None)
+            retries.stop()
+            autoscaler.stop()
+            # retire the details workers
+            autoscaler.scale_to(0)
+            # the workers hold the listing and with it the sink, none may outlive the download
+            for worker in list_workers + autoscaler.workers:
+                worker.join()
+        errors = [worker.error for worker in list_workers + autoscaler.workers if worker.error is not None]
+        if errors:
+            raise errors[0]
+        if listing.failed_pages and not stop.is_set():
+            raise IncompleteDownload(sorted(listing.failed_pages))
         logging.info(f"time took to process the records: {time.time() - ts}")
-        logging.info(f"firstly processed records : {len(customer_details_list)}")
+        processed_records = listing.from_cache + sum(
+            worker.processed_records - worker.rejected_records for worker in autoscaler.workers)
+        logging.info(f"Total processed records : {processed_records}, failed for good : {retries.dead_letters}")
+        return processed_records
 
-        for rejectedemails_thread in range(5):
-            worker2 = SwellRejectedEmailsWorker(rejectedemail_queue,
-                                                self.guid, self.api_key, rejectedemails_thread)
-            worker2.setDaemon(True)
-            worker2.start()
+    def iter_download(self, date, mode='threads', concurrency=200, buffer_size=1000):
+        """ Yield every customer's details as a json string as soon as it is downloaded
 
-        rejectedemail_queue.join()
-        logging.info(f"Total processed records : {len(customer_details_list)}")
-        return customer_details_list
+            At most buffer_size records wait for the consumer, the download
+            pauses while the buffer is full. Stopping the iteration early
+            cancels the download and waits for its workers to wind down.
+        """
+        records = Queue(maxsize=buffer_size)
+        finished = object()
+        stop = Event()
+        errors = []
+
+        def sink(record):
+            if not stop.is_set():
+                records.put(record)
+
+        def run():
+            try:
+                self.download(date, mode=mode, concurrency=concurrency, sink=sink, stop=stop)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                records.put(finished)
+
+        download = Thread(target=run, daemon=True)
+        download.start()
+        try:
+            while True:
+                record = records.get()
+                if record is finished:
+                    break
+                yield record
+        finally:
+            stop.set()
+            while download.is_alive():
+                # unblock a worker waiting on the full buffer
+                while not records.empty():
+                    records.get_nowait()
+                download.join(0.1)
+        if errors:
+            raise errors[0]
 
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class CustomerDetailsCache(object):
+    """ Customer details of earlier Swell downloads in a sqlite file, keyed by email
+
+        Every customer's details are stored with a fingerprint of the entry the
+        customer list had for them when they were fetched, and its last_seen_at.
+        While that entry stays the same the customer has not changed, and the
+        cached details are used instead of fetching them again. New details are
+        committed commit_every at a time; the ones lost in a crash are fetched
+        again on the next run.
+    """
+    # sqlite's limit of parameters in a statement is 999 on older versions
+    LOOKUP_BATCH = 500
+
+    def __init__(self, path, commit_every=1000):
+        self.path = path
+        self.commit_every = commit_every
+        # fingerprint and last_seen_at of the changed customers, until their details are stored
+        self.pending = {}
+        self.rows = []
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS customers (email TEXT PRIMARY KEY, fingerprint TEXT, last_seen_at TEXT,
+                                                  details TEXT, fetched_at REAL)
+        ''')
+        self.connection.commit()
+
+    @staticmethod
+    def fingerprint(customer):
+        """ Content hash of a customer's entry in the customer list """
+        return hashlib.blake2b(json.dumps(customer, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+    def unchanged(self, customers):
+        """ Cached details of the listed customers whose entry has not changed, as {email: details}
+
+            The other customers are remembered, so the details fetched for them
+            are stored with their new entry's fingerprint.
+        """
+        entries = {customer['email']: (self.fingerprint(customer), customer.get('last_seen_at'))
+                   for customer in customers}
+        emails = list(entries)
+        cached = {}
+        with self.lock:
+            for start in range(0, len(emails), self.LOOKUP_BATCH):
+                batch = emails[start:start + self.LOOKUP_BATCH]
+                rows = self.connection.execute(
+                    f"SELECT email, fingerprint, details FROM customers WHERE email IN ({','.join('?' * len(batch))})",
+                    batch)
+                cached.update((email, details) for email, fingerprint, details in rows
+                              if fingerprint == entries[email][0])
+            for email, entry in entries.items():
+                if email not in cached:
+                    self.pending[email] = entry
+        return cached
+
+    def store(self, email, details):
+        """ Cache the details just fetched for email """
+        with self.lock:
+            # without a listed entry (a resumed download) the details are fetched again next time
+            fingerprint, last_seen_at = self.pending.pop(email, (None, None))
+            self.rows.append((email, fingerprint, last_seen_at, details, time.time()))
+            if len(self.rows) >= self.commit_every:
+                self._commit()
+
+    def _commit(self):
+        self.connection.executemany('INSERT OR REPLACE INTO customers VALUES (?, ?, ?, ?, ?)', self.rows)
+        self.connection.commit()
+        self.rows = []
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.connection.close()
@@ -0,0 +1,118 @@
+import sqlite3
+import threading
+import time
+
+
+class DownloadCheckpoint(object):
+    """ Durable progress of a SwellWrapper.download, so an interrupted run resumes where it stopped
+
+        A sqlite file records the number of pages, the pages listed with the
+        emails found on them, and the emails whose details reached the sink.
+        A resumed download of the same date only lists the remaining pages and
+        fetches the remaining emails. Pages that failed are recorded too and
+        listed again on the next run. Finished emails are committed
+        commit_every at a time, after flushing the sink (before_commit), so
+        after a crash a few records may be delivered twice but none are lost.
+        The checkpoint of a date is cleared when its download finishes.
+    """
+
+    def __init__(self, path, date, commit_every=1000):
+        self.path = path
+        self.date = f'{date}'
+        self.commit_every = commit_every
+        # called before finished emails are committed, a sink's flush
+        self.before_commit = None
+        self.done = []
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (date TEXT PRIMARY KEY, total_pages INTEGER, started REAL);
+            CREATE TABLE IF NOT EXISTS pages (date TEXT, page INTEGER, PRIMARY KEY (date, page));
+            CREATE TABLE IF NOT EXISTS failed_pages (date TEXT, page INTEGER, error TEXT, PRIMARY KEY (date, page));
+            CREATE TABLE IF NOT EXISTS emails (date TEXT, email TEXT, done INTEGER DEFAULT 0,
+                                               PRIMARY KEY (date, email));
+        ''')
+        self.connection.commit()
+
+    @property
+    def total_pages(self):
+        with self.lock:
+            row = self.connection.execute('SELECT total_pages FROM runs WHERE date = ?', (self.date,)).fetchone()
+        return row[0] if row else None
+
+    def set_total_pages(self, total_pages):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)',
+                                    (self.date, total_pages, time.time()))
+            self.connection.commit()
+
+    def completed_pages(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT page FROM pages WHERE date = ?', (self.date,))
+            return {page for page, in rows}
+
+    def failed_pages(self):
+        """ Pages whose listing failed and has not succeeded since """
+        with self.lock:
+            rows = self.connection.execute('SELECT page FROM failed_pages WHERE date = ?', (self.date,))
+            return {page for page, in rows}
+
+    def listed_emails(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT email FROM emails WHERE date = ?', (self.date,))
+            return [email for email, in rows]
+
+    def pending_emails(self):
+        """ Emails found on listed pages whose details have not reached the sink yet """
+        with self.lock:
+            rows = self.connection.execute('SELECT email FROM emails WHERE date = ? AND done = 0', (self.date,))
+            return [email for email, in rows]
+
+    def page_done(self, page, emails):
+        """ Record a listed page together with its emails, in one transaction """
+        with self.lock:
+            self.connection.executemany('INSERT OR IGNORE INTO emails (date, email) VALUES (?, ?)',
+                                        [(self.date, email) for email in emails])
+            self.connection.execute('INSERT OR IGNORE INTO pages VALUES (?, ?)', (self.date, page))
+            self.connection.execute('DELETE FROM failed_pages WHERE date = ? AND page = ?', (self.date, page))
+            self.connection.commit()
+
+    def page_failed(self, page, error):
+        """ Record a page that could not be listed, so the next run lists it again """
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO failed_pages VALUES (?, ?, ?)',
+                                    (self.date, page, f'{error}'))
+            self.connection.commit()
+
+    def email_done(self, email):
+        with self.lock:
+            self.done.append(email)
+            if len(self.done) >= self.commit_every:
+                self._commit()
+
+    def _commit(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        self.connection.executemany('UPDATE emails SET done = 1 WHERE date = ? AND email = ?',
+                                    [(self.date, email) for email in self.done])
+        self.connection.commit()
+        self.done = []
+
+    def flush(self):
+        """ Commit every finished email """
+        with self.lock:
+            self._commit()
+
+    def finish(self):
+        """ The download completed, forget its progress """
+        with self.lock:
+            self.done = []
+            for table in ['runs', 'pages', 'failed_pages', 'emails']:
+                self.connection.execute(f'DELETE FROM {table} WHERE date = ?', (self.date,))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,206 @@
+""" Benchmark of the ProcessDMA stages on synthetic data
+
+    python -m benchmarks.process_dma_benchmark --scales 1 10 --output results.json
+    python -m benchmarks.process_dma_benchmark --scales 1 --compare results.json
+
+Every generator is seeded, so two runs (or two commits) time the same data.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from api_connectors.DmaMetrics import StageMetrics
+from api_connectors.ProcessDMA import ProcessDMA, DMA_ALIASES
+
+# production size at scale 1
+PRODUCTION_CUSTOMERS = 500000
+PRODUCTION_MONTHS = 36
+# the census is national, it does not grow with the scale (zip codes are 5 digits)
+CENSUS_ZIPS = 33000
+DMA_COUNT = 210
+
+FEMALE_AGE_COLUMNS = [f'col_females_{age}_{age + 4}' for age in range(20, 65, 5)]
+HH_INCOME_COLUMNS = ['col_hh_est', 'col_hh_0_10k', 'col_hh_10_15k', 'col_hh_15_25k', 'col_hh_25_35k',
+                     'col_hh_35_50k', 'col_hh_50_75k', 'col_hh_75_100k', 'col_hh_100_150k', 'col_hh_150_200k',
+                     'col_hh_200k_plus']
+ATTAINED_COLUMNS = ['col_attained_no_high_school', 'col_attained_some_high_school',
+                    'col_attained_high_school_graduate', 'col_attained_some_college', 'col_attained_associates',
+                    'col_attained_bachelors', 'col_attained_graduate_professional']
+# process_population treats every column from the 28th on as a feature
+FEATURE_COLUMNS = ['col_hh_med_income', 'col_hh_avg_income', 'col_median_age', 'col_hu_med_rent',
+                   'col_hu_med_home_value'] + ATTAINED_COLUMNS + [
+                   'col_white', 'col_hispanic', 'col_black', 'col_indian', 'col_asian', 'col_hu_owner_occ',
+                   'col_hu_renter_occ', 'col_hu_occupied', 'col_in_college']
+
+
+def dma_names(count=DMA_COUNT):
+    """ Census style dma names, starting with the ones that have aliases """
+    names = list(DMA_ALIASES)[:count]
+    return names + [f'Synthetic {i} et al, XX' for i in range(len(names), count)]
+
+
+def generate_population(zips=CENSUS_ZIPS, seed=0):
+    """ Census population frame as it comes from the database, every value a string """
+    rng = np.random.RandomState(seed)
+    dmas = dma_names()
+    dma_index = rng.randint(0, len(dmas), zips)
+    population = pd.DataFrame({
+        # leading zeros are stripped in the source data
+        'zip': rng.choice(np.arange(501, 99951), zips, replace=False).astype(str),
+        'dma': np.array(dmas, dtype=object)[dma_index],
+        'dma_cd': (500 + dma_index).astype(str),
+        'state': 'XX',
+        'city': 'Synthetic',
+        'total_female_pop': rng.randint(100, 30000, zips).astype(str),
+        'col_pop_2010': rng.randint(0, 60000, zips).astype(str),
+    })
+    for col in FEMALE_AGE_COLUMNS:
+        population[col] = rng.randint(0, 2000, zips).astype(str)
+    brackets = rng.randint(0, 900, (zips, len(HH_INCOME_COLUMNS) - 1))
+    population['col_hh_est'] = (brackets.sum(axis=1) + 1).astype(str)
+    for i, col in enumerate(HH_INCOME_COLUMNS[1:]):
+        population[col] = brackets[:, i].astype(str)
+    # the features start at the 28th column, where process_population expects them
+    assert len(population.columns) == 27
+
+    for col in FEATURE_COLUMNS:
+        population[col] = rng.randint(0, 5000, zips).astype(str)
+    population['col_hh_med_income'] = rng.randint(20000, 250000, zips).astype(str)
+    population['col_hh_avg_income'] = rng.randint(20000, 300000, zips).astype(str)
+    population['col_median_age'] = np.round(rng.uniform(20, 60, zips), 1).astype(str)
+    population['col_hu_med_home_value'] = rng.randint(50000, 2000000, zips).astype(str)
+    return population
+
+
+def months(count):
+    return pd.date_range('2018-02-01', periods=count, freq='MS').strftime('%Y-%m-%d')
+
+
+def generate_ship_zip(population, customers, seed=1):
+    """ Customer shipping zips with the usual noise: zip+4, 'n/a', foreign postcodes and unknown zips """
+    rng = np.random.RandomState(seed)
+    zips = rng.choice(population['zip'].str.zfill(5).to_numpy(), customers).astype(object)
+    noise = rng.rand(customers)
+    zips[noise < 0.03] = 'n/a'
+    zip_plus_4 = (noise >= 0.03) & (noise < 0.13)
+    zips[zip_plus_4] = zips[zip_plus_4] + '-1234'
+    zips[(noise >= 0.13) & (noise < 0.15)] = 'A1B 2C3'
+    zips[(noise >= 0.15) & (noise < 0.16)] = '00000'
+    ship_zip = pd.DataFrame({
+        'customer_key': np.arange(customers),
+        'first_order_month': rng.choice(months(PRODUCTION_MONTHS), customers).astype(object),
+        'zip': zips,
+        'lifetime_net_amount': rng.uniform(0, 500, customers).round(2),
+        'total_orders': rng.randint(0, 5, customers),
+    })
+    # prospects have no first order, they are counted in the month they signed up
+    ship_zip['created_month'] = rng.choice(months(PRODUCTION_MONTHS), customers)
+    ship_zip.loc[ship_zip['total_orders'] == 0, 'first_order_month'] = None
+    return ship_zip
+
+
+def generate_aggregates(data_directory, scale, seed=2):
+    """ Write prospects_agg.csv and shoppers_agg.csv, one (month, dma) row per source system and scale """
+    rng = np.random.RandomState(seed)
+    dmas = dma_names() + [None]
+    grid = pd.MultiIndex.from_product([months(PRODUCTION_MONTHS), dmas] + [range(scale)]).to_frame(index=False)
+    for name in ['prospects_agg', 'shoppers_agg']:
+        aggregate = pd.DataFrame({'month': grid[0], 'dma': grid[1], 'count': rng.randint(0, 500, len(grid))})
+        aggregate.to_csv(os.path.join(data_directory, name + '.csv'), sep='|', index=False)
+
+
+def run_scale(scale, storage='csv', seed=0, profile_dir=None, session=False):
+    """ Time every stage at one scale, returns a result row per stage """
+    with tempfile.TemporaryDirectory() as data_directory:
+        population = generate_population(seed=seed)
+        ship_zip = generate_ship_zip(population, PRODUCTION_CUSTOMERS * scale, seed=seed + 1)
+        generate_aggregates(data_directory, scale, seed=seed + 2)
+
+        if profile_dir:
+            profile_dir = os.path.join(profile_dir, f'{scale}x')
+        metrics = StageMetrics(profile_dir=profile_dir)
+        dma = ProcessDMA(data_directory, storage=storage, metrics=metrics, session=session)
+        dma.process_population(population)
+        dma.process_ship_zip_dma(ship_zip)
+        dma.numerator2()
+        dma.final_denominator()
+        dma.flush()
+
+    results = []
+    for record in metrics.records:
+        peak_memory_mb = record['peak_memory_bytes'] / 2 ** 20
+        print(f"scale {scale:>4}x  {record['stage']:<22} {record['wall_seconds']:8.2f}s "
+              f"{peak_memory_mb:10.1f} MB")
+        results.append({'scale': scale, 'stage': record['stage'], 'rows': record['rows_read'],
+                        'seconds': record['wall_seconds'], 'cpu_seconds': record['cpu_seconds'],
+                        'peak_memory_mb': peak_memory_mb, 'bytes_read': record['bytes_read'],
+                        'bytes_written': record['bytes_written']})
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(current, baseline):
+    """ Relative change from baseline to current, n/a when there is nothing to compare against """
+    if current is None or not baseline:
+        return f"{'n/a':>8}"
+    return f"{current / baseline - 1:+8.1%}"
+
+
+def compare(baseline, current):
+    """ Print the change of every stage between two result files' contents """
+    previous = {(row['scale'], row['stage']): row for row in baseline['results']}
+    print(f"baseline {baseline.get('commit')} -> current {current.get('commit')}")
+    for row in current['results']:
+        before = previous.get((row['scale'], row['stage']))
+        if before is None:
+            continue
+        print(f"scale {row['scale']:>4}x  {row['stage']:<22} "
+              f"time {change(row['seconds'], before['seconds'])}  "
+              f"memory {change(row['peak_memory_mb'], before['peak_memory_mb'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                        help='multiples of the production size to run')
+    parser.add_argument('--storage', default='csv', help='ProcessDMA storage backend')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', help='json results of an earlier run to compare against')
+    parser.add_argument('--session', action='store_true', help='hand frames between stages in memory')
+    parser.add_argument('--profile', help='dump a cProfile of every stage into this directory')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'storage': args.storage,
+        'session': args.session,
+        'results': [row for scale in args.scales
+                    for row in run_scale(scale, storage=args.storage, profile_dir=args.profile, session=args.session)],
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+""" Benchmark of SwellWrapper.download against the local mock Swell API
+
+    python -m benchmarks.swell_download_benchmark --modes threads async --customers 20000 --output results.json
+    python -m benchmarks.swell_download_benchmark --error-rate 0.02 --rate-limit 300 --compare results.json
+
+The mock server runs in its own process, so it does not compete with the downloader for the GIL. Reports the
+records per second, the p50 / p99 latency of the API calls as the downloader sees them (limiter waits and
+retries included) and the peak memory of every mode.
+"""
+import argparse
+import datetime
+import json
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+from api_connectors.DmaMetrics import PeakMemorySampler
+from api_connectors.RateLimiter import RetryPolicy, TokenBucketLimiter
+from api_connectors.SwellApi import SwellWrapper
+from benchmarks.process_dma_benchmark import change, git_commit
+from benchmarks.swell_mock_server import add_server_arguments
+
+
+class TimedSwellWrapper(SwellWrapper):
+    """ SwellWrapper recording the time every API call takes """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedSwellWrapper, self).__init__(*args, **kwargs)
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def _record(self, ts):
+        latency = time.perf_counter() - ts
+        with self.lock:
+            self.latencies.append(latency)
+
+    def make_api_call(self, *args, **kwargs):
+        ts = time.perf_counter()
+        try:
+            return super(TimedSwellWrapper, self).make_api_call(*args, **kwargs)
+        finally:
+            self._record(ts)
+
+    async def _make_api_call_async(self, *args, **kwargs):
+        ts = time.perf_counter()
+        try:
+            return await super(TimedSwellWrapper, self)._make_api_call_async(*args, **kwargs)
+        finally:
+            self._record(ts)
+
+
+class CountingSink(object):
+    """ Counts the records and bytes downloaded, without keeping them """
+
+    def __init__(self):
+        self.records = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.lock:
+            self.records += 1
+            self.bytes += len(record)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port, timeout=30):
+    """ Run the mock server in a subprocess with the server options of args, returns the process """
+    command = [sys.executable, '-m', 'benchmarks.swell_mock_server', '--port', f'{port}',
+               '--customers', f'{args.customers}', '--latency', args.latency, '--latency-ms', f'{args.latency_ms}',
+               '--latency-sigma', f'{args.latency_sigma}', '--error-rate', f'{args.error_rate}',
+               '--throttle-rate', f'{args.throttle_rate}', '--not-found-rate', f'{args.not_found_rate}',
+               '--seed', f'{args.seed}']
+    if args.rate_limit:
+        command += ['--rate-limit', f'{args.rate_limit}']
+    server = subprocess.Popen(command)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/stats', timeout=1)
+            return server
+        except requests.exceptions.ConnectionError:
+            if server.poll() is not None:
+                raise Exception(f"mock server exited with {server.returncode}")
+            time.sleep(0.1)
+    server.kill()
+    raise Exception('mock server did not start')
+
+
+def run_mode(mode, args):
+    """ Download every customer of a fresh mock server in mode, returns the result row """
+    port = free_port()
+    server = start_server(args, port)
+    try:
+        retry_policy = None
+        if args.client_rate:
+            retry_policy = RetryPolicy(TokenBucketLimiter(rate=args.client_rate,
+                                                          max_rate=max(args.client_rate, args.client_max_rate)))
+        wrapper = TimedSwellWrapper('benchmark', 'benchmark', retry_policy=retry_policy)
+        base_url = f'http://127.0.0.1:{port}/api/'
+        wrapper.all_customers_url = base_url + wrapper.ALL_CUSTOMERS
+        wrapper.customer_details_url = base_url + wrapper.CUSTOMER_DETAILS
+        sink = CountingSink()
+        dead_letters = []
+
+        sampler = PeakMemorySampler()
+        sampler.start()
+        ts = time.perf_counter()
+        wrapper.download('2020-01-01', mode=mode, concurrency=args.concurrency, sink=sink,
+                         dead_letter=dead_letters.append)
+        seconds = time.perf_counter() - ts
+        peak_memory = sampler.stop()
+        server_stats = requests.get(f'http://127.0.0.1:{port}/stats').json()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = np.array(wrapper.latencies) * 1000
+    result = {
+        'mode': mode,
+        'records': sink.records,
+        'dead_letters': len(dead_letters),
+        'seconds': seconds,
+        'records_per_second': sink.records / seconds,
+        'api_calls': len(latencies),
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'peak_memory_mb': peak_memory / 2 ** 20,
+        'megabytes': sink.bytes / 2 ** 20,
+        'server_responses': server_stats['responses'],
+    }
+    print(f"{mode:<8} {result['records']:>8} records {seconds:8.1f}s {result['records_per_second']:8.0f}/s  "
+          f"p50 {result['p50_ms']:7.1f}ms  p99 {result['p99_ms']:8.1f}ms  peak {result['peak_memory_mb']:7.1f} MB  "
+          f"dead letters {result['dead_letters']}  server {server_stats['responses']}")
+    return result
+
+
+def compare(baseline, current):
+    """ Print the change of every mode between two result files' contents """
+    previous = {row['mode']: row for row in baseline['results']}
+    print(f"baseline {baseline.get('commit')} -> current {current.get('commit')}")
+    for row in current['results']:
+        before = previous.get(row['mode'])
+        if before is None:
+            continue
+        print(f"{row['mode']:<8} records/s {change(row['records_per_second'], before['records_per_second'])}  "
+              f"p99 {change(row['p99_ms'], before['p99_ms'])}  "
+              f"memory {change(row['peak_memory_mb'], before['peak_memory_mb'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['threads', 'async'], help='download modes to run')
+    parser.add_argument('--concurrency', type=int, default=200, help='requests in flight in async mode')
+    parser.add_argument('--client-rate', type=float,
+                        help='requests per second the client starts at, the wrapper default when not given')
+    parser.add_argument('--client-max-rate', type=float, default=SwellWrapper.MAX_RATE_LIMIT,
+                        help='requests per second the client may grow to')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', help='json results of an earlier run to compare against')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'server': {name: value for name, value in vars(args).items()
+                   if name not in ('modes', 'output', 'compare')},
+        'results': [run_mode(mode, args) for mode in args.modes],
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
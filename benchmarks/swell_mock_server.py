@@ -0,0 +1,182 @@
+""" Local stand-in for the Swell API, to load-test SwellWrapper.download without spending API quota
+
+    python -m benchmarks.swell_mock_server --port 8080 --customers 20000 --latency lognormal --latency-ms 80
+
+Serves v2/customers/all/ (paged, with links.total_pages) and v2/customers/ under /api/, with latency drawn
+from a distribution, a share of failing requests and 429s from a server-side rate limit. Every request's
+latency and failure are drawn from a generator seeded with the seed, the request and how often it was asked
+before, so two runs see the same errors. GET /stats returns the responses sent by status.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+
+from aiohttp import web
+
+LATENCY_DISTRIBUTIONS = ['constant', 'uniform', 'exponential', 'lognormal']
+
+
+class MockSwellServer(object):
+    """ The endpoints of the Swell API used by SwellWrapper, over customers synthetic customers
+
+        latency_ms is the median latency; uniform draws between 0 and twice
+        that and lognormal spreads it by latency_sigma. error_rate of the
+        requests fail with a 500 and throttle_rate with a 429; beyond rate_limit
+        requests per second every request gets a 429 with a Retry-After.
+        not_found_rate of the customers are unknown to the details endpoint.
+    """
+
+    def __init__(self, customers=10000, per_page=100, latency='lognormal', latency_ms=50.0, latency_sigma=0.5,
+                 error_rate=0.0, throttle_rate=0.0, rate_limit=None, not_found_rate=0.0, actions=10, seed=0):
+        self.customers = customers
+        self.per_page = per_page
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.not_found_rate = not_found_rate
+        self.actions = actions
+        self.seed = seed
+        self.asked = collections.Counter()
+        self.responses = collections.Counter()
+        self.tokens = rate_limit or 0.0
+        self.updated = time.monotonic()
+
+    def email(self, index):
+        return f'customer{index:07d}@example.com'
+
+    def _random(self, key):
+        # the same request gets the same draws in every run, whatever the order requests arrive in
+        self.asked[key] += 1
+        return random.Random(f'{self.seed}:{key}:{self.asked[key]}')
+
+    def _latency(self, rng):
+        if self.latency == 'constant':
+            seconds = self.latency_ms
+        elif self.latency == 'uniform':
+            seconds = rng.uniform(0, 2 * self.latency_ms)
+        elif self.latency == 'exponential':
+            seconds = rng.expovariate(1 / self.latency_ms) if self.latency_ms else 0.0
+        else:
+            seconds = self.latency_ms * rng.lognormvariate(0, self.latency_sigma)
+        return seconds / 1000
+
+    def _throttled(self):
+        """ Seconds until the rate limit lets a request in, 0 when it does now """
+        if not self.rate_limit:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate_limit
+
+    def _respond(self, status, body=None, headers=None):
+        self.responses[status] += 1
+        if body is None:
+            return web.Response(status=status, text=json.dumps({'error': f'mock error {status}'}), headers=headers,
+                                content_type='application/json')
+        return web.json_response(body, status=status)
+
+    async def _failure(self, request, key):
+        """ The error response the request gets, None when it succeeds """
+        if 'x-guid' not in request.headers or 'x-api-key' not in request.headers:
+            return self._respond(401)
+        wait = self._throttled()
+        if wait:
+            return self._respond(429, headers={'Retry-After': f'{max(1, round(wait))}'})
+        rng = self._random(key)
+        await asyncio.sleep(self._latency(rng))
+        draw = rng.random()
+        if draw < self.error_rate:
+            return self._respond(500)
+        if draw < self.error_rate + self.throttle_rate:
+            return self._respond(429, headers={'Retry-After': '1'})
+        return None
+
+    def total_pages(self, per_page):
+        return (self.customers + per_page - 1) // per_page
+
+    async def all_customers(self, request):
+        per_page = int(request.query.get('per_page', self.per_page))
+        page = int(request.query.get('page', 1))
+        failure = await self._failure(request, f'page:{per_page}:{page}')
+        if failure is not None:
+            return failure
+        first = (page - 1) * per_page
+        customers = [{'email': self.email(index), 'last_seen_at': request.query.get('last_seen_at'),
+                      'points_balance': index % 1000}
+                     for index in range(first, min(self.customers, first + per_page))]
+        return self._respond(200, {'customers': customers, 'links': {'total_pages': self.total_pages(per_page),
+                                                                     'page': page}})
+
+    async def customer_details(self, request):
+        email = request.query.get('customer_email', '')
+        failure = await self._failure(request, f'details:{email}')
+        if failure is not None:
+            return failure
+        rng = random.Random(f'{self.seed}:{email}')
+        if not email.startswith('customer') or rng.random() < self.not_found_rate:
+            return self._respond(404)
+        return self._respond(200, {
+            'email': email,
+            'first_name': 'Mock',
+            'last_name': email.split('@')[0],
+            'points_balance': rng.randint(0, 10000),
+            'referral_code': f'{rng.getrandbits(32):08x}',
+            'vip_tier': {'id': rng.randint(1, 4), 'name': rng.choice(['Bronze', 'Silver', 'Gold', 'Platinum'])},
+            'actions': [{'id': action, 'name': 'Made a purchase', 'points': rng.randint(1, 500),
+                         'created_at': '2020-01-01T00:00:00Z'} for action in range(self.actions)],
+        })
+
+    async def stats(self, request):
+        return web.json_response({'responses': {f'{status}': count for status, count in self.responses.items()},
+                                  'requests': sum(self.responses.values())})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/api/v2/customers/all/', self.all_customers)
+        app.router.add_get('/api/v2/customers/', self.customer_details)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+
+def add_server_arguments(parser):
+    """ Command line options of the mock server, shared with the benchmark """
+    parser.add_argument('--customers', type=int, default=10000, help='customers in the customer list')
+    parser.add_argument('--latency', choices=LATENCY_DISTRIBUTIONS, default='lognormal',
+                        help='distribution of the response latency')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='median response latency')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='spread of the lognormal latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests getting a 429')
+    parser.add_argument('--rate-limit', type=float, help='requests per second before every request gets a 429')
+    parser.add_argument('--not-found-rate', type=float, default=0.0, help='share of customers without details')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def server_from_arguments(args):
+    return MockSwellServer(customers=args.customers, latency=args.latency, latency_ms=args.latency_ms,
+                           latency_sigma=args.latency_sigma, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, rate_limit=args.rate_limit,
+                           not_found_rate=args.not_found_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(server_from_arguments(args).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()